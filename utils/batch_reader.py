@@ -0,0 +1,242 @@
+from __future__ import print_function, division
+import os
+import glob
+import json
+import time
+import queue
+import argparse
+import threading
+import numpy as np
+import h5py
+from convert_to_h5 import extendable_datasets, offsets_name, read_rows, take_rows, count_rows, ragged_to_padded
+from npy_output import load_npy_directory
+
+def open_converted(path):
+    '''datasets of a converter output, an HDF5 file or an npy directory of memory-mapped arrays'''
+    if os.path.isdir(path):
+        arrays, _ = load_npy_directory(path)
+        with open(os.path.join(path, 'manifest.json')) as f:
+            manifest = json.load(f)
+        return arrays, {name: arrays[name] for name, d in manifest['datasets'].items() if d.get('extendable')}
+    inFile = h5py.File(path, 'r')
+    return inFile, extendable_datasets(inFile)
+
+# pt columns telling real objects from padding in outputs written before the padding_reference attribute
+LEGACY_REFERENCES = {'fatjets': 'jetFeatureNames', 'jetConstituentList': 'particleFeatureNames'}
+
+def padding_references(path):
+    '''dataset -> (dataset, pt column) whose non-zero pt marks the real objects of each dataset stored
+    padded, from the padding_reference attribute of the converter or the naming conventions of older
+    outputs. Ragged datasets are left out, their masks come from the offsets'''
+    inFile, datasets = open_converted(path)
+    try:
+        if isinstance(inFile, h5py.File):
+            attrs = dict(inFile.attrs)
+        else:
+            with open(os.path.join(path, 'manifest.json')) as f:
+                attrs = json.load(f)['attrs']
+        references = {}
+        if 'padding_reference' in attrs:
+            references = {name: tuple(ref) for name, ref in json.loads(attrs['padding_reference']).items()}
+        for name in ([] if references else datasets):
+            prefix = name.rsplit('_', 1)[0]
+            if prefix+'_cyl' in datasets:
+                references[name] = (prefix+'_cyl', 0)
+            for reference in (name, prefix):
+                if LEGACY_REFERENCES.get(reference) in inFile:
+                    features = [f.decode() if isinstance(f, bytes) else f for f in inFile[LEGACY_REFERENCES[reference]][()]]
+                    pt = [i for i, f in enumerate(features) if f.endswith('_pt')]
+                    if pt:
+                        references[name] = (reference, pt[0])
+        return {name: ref for name, ref in references.items()
+                if name in datasets and ref[0] in datasets and not offsets_name(name, datasets)}
+    finally:
+        if isinstance(inFile, h5py.File):
+            inFile.close()
+
+def block_rows(inFile, names, batch_size):
+    '''rows read at a time: whole HDF5 chunks of the per-row (or offsets) datasets, at least batch_size'''
+    rows = 0
+    for name in names:
+        dataset = inFile[offsets_name(name, inFile) or name]
+        rows = max(rows, dataset.chunks[0] if getattr(dataset, 'chunks', None) else 0)
+    rows = rows or batch_size
+    return rows*max(1, -(-batch_size//rows))
+
+def read_blocks(paths, names, batch_size, order=None):
+    '''yield write_chunk style dicts (ragged datasets with per-row counts) of consecutive row blocks'''
+    for path in paths:
+        inFile, datasets = open_converted(path)
+        try:
+            selected = [name for name in (names or datasets) if not name.endswith('_offsets')]
+            nrows = count_rows(inFile, selected)
+            step = block_rows(inFile, selected, batch_size)
+            starts = list(range(0, nrows, step))
+            if order is not None:
+                order.shuffle(starts)
+            for start in starts:
+                yield read_rows(inFile, selected, start, min(start+step, nrows))
+        finally:
+            if isinstance(inFile, h5py.File):
+                inFile.close()
+
+def prefetch(iterable, depth=2):
+    '''iterate in a background thread keeping up to depth items ready'''
+    done, stop, errors = object(), threading.Event(), []
+    items = queue.Queue(depth)
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def worker():
+        try:
+            for item in iterable:
+                if not put(item):
+                    return
+        except BaseException as error:
+            errors.append(error)
+        put(done)
+
+    thread = threading.Thread(target=worker)
+    thread.daemon = True
+    thread.start()
+    try:
+        for item in iter(items.get, done):
+            yield item
+        if errors:
+            raise errors[0]
+    finally:
+        stop.set()
+        thread.join()
+
+def concat_rows(first, second):
+    '''concatenate two write_chunk style dicts along the rows'''
+    if first is None:
+        return second
+    return {name: np.concatenate([first[name], second[name]]) for name in first}
+
+def num_rows(block):
+    '''number of rows of a write_chunk style dict'''
+    for name, data in block.items():
+        if name.endswith('_offsets') or not offsets_name(name, block):
+            return len(data)
+    return 0
+
+def to_batch(block, layout='padded', maxN=None, mask=False, references=None):
+    '''NumPy batch of a write_chunk style dict: ragged datasets zero-padded to maxN (an int, a dict per
+    dataset or None for the longest row of the batch) with an optional <name>_mask of real objects,
+    or with the ragged layout flat values and int64 <name>_offsets starting at 0. The masks of datasets
+    stored padded come from the non-zero pt of their references, see padding_references'''
+    batch = {}
+    references = references or {}
+    for name, data in block.items():
+        counts = offsets_name(name, block)
+        if name.endswith('_offsets'):
+            if layout == 'ragged':
+                batch[name] = np.concatenate([[0], np.cumsum(data)])
+            continue
+        if counts is None or layout == 'ragged':
+            batch[name] = data
+        else:
+            n = maxN.get(name) if isinstance(maxN, dict) else maxN
+            batch[name] = ragged_to_padded(data, np.concatenate([[0], np.cumsum(block[counts])]), n)
+        if mask and counts is not None and layout != 'ragged':
+            batch[name+'_mask'] = np.arange(batch[name].shape[1]) < block[counts][:,None]
+        elif mask and counts is None and name in references and references[name][0] in block:
+            # objects stored padded, real where the pt of the reference is non-zero
+            reference, column = references[name]
+            batch[name+'_mask'] = block[reference][...,column] != 0
+    return batch
+
+class RowPool(object):
+    '''rows of write_chunk style blocks waiting to be batched. Rows are referenced by (block, row) and
+    copied once, when drawn into a batch. With an rng the references are shuffled whenever a block is
+    added and batches are drawn from the end, otherwise rows leave in the order they were added'''
+    def __init__(self, rng=None):
+        self.rng = rng
+        self.blocks, self.remaining = {}, {}
+        self.refs = np.zeros((0, 2), dtype='i8')
+        self.next_block = 0
+
+    def __len__(self):
+        return len(self.refs)
+
+    def add(self, block):
+        n = num_rows(block)
+        self.blocks[self.next_block], self.remaining[self.next_block] = block, n
+        refs = np.stack([np.full(n, self.next_block), np.arange(n)], axis=1)
+        self.refs = np.concatenate([self.refs, refs])
+        self.next_block += 1
+        if self.rng is not None:
+            self.refs = self.refs[self.rng.permutation(len(self.refs))]
+
+    def draw(self, n):
+        '''n rows as a write_chunk style dict, grouped by the block they come from'''
+        if self.rng is not None:
+            refs, self.refs = self.refs[len(self.refs)-n:], self.refs[:len(self.refs)-n]
+        else:
+            refs, self.refs = self.refs[:n], self.refs[n:]
+        batch = None
+        for block_id in np.unique(refs[:,0]):
+            rows = np.sort(refs[refs[:,0] == block_id, 1]) if self.rng is None else refs[refs[:,0] == block_id, 1]
+            batch = concat_rows(batch, take_rows(self.blocks[block_id], rows))
+            self.remaining[block_id] -= len(rows)
+            if not self.remaining[block_id]:
+                del self.blocks[block_id], self.remaining[block_id]
+        return batch
+
+def iterate_batches(paths, batch_size=256, datasets=None, shuffle_buffer=0, seed=None, prefetch_blocks=2,
+                    layout='padded', maxN=None, mask=False, drop_last=False):
+    '''iterate over NumPy batches of batch_size rows of converter outputs (files, npy directories or globs).
+    Whole chunks are read and prefetch_blocks of them prepared in a background thread. With shuffle_buffer,
+    chunks are read in random order and rows drawn at random from a pool of that many rows'''
+    if isinstance(paths, str):
+        paths = [paths]
+    paths = [p for pattern in paths for p in (sorted(glob.glob(pattern)) or [pattern])]
+    rng = np.random.default_rng(seed) if shuffle_buffer else None
+    if rng is not None:
+        paths = [paths[i] for i in rng.permutation(len(paths))]
+    references = padding_references(paths[0]) if mask and paths else {}
+    # the pt datasets the masks come from are read along and dropped from the batches
+    extra = sorted(set(references[n][0] for n in datasets if n in references) - set(datasets)) if datasets else []
+    names = list(datasets) + extra if datasets else datasets
+
+    def batch(block):
+        converted = to_batch(block, layout, maxN, mask, references)
+        return {name: data for name, data in converted.items() if name not in extra and name[:-5] not in extra}
+
+    pool = RowPool(rng)
+    for block in prefetch(read_blocks(paths, names, batch_size, rng), prefetch_blocks):
+        pool.add(block)
+        while len(pool) >= max(batch_size, shuffle_buffer):
+            yield batch(pool.draw(batch_size))
+    while len(pool) >= (batch_size if drop_last else 1):
+        yield batch(pool.draw(min(batch_size, len(pool))))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--inpfile', type=str, nargs='+', required=True, help='Converter outputs, globs or npy directories')
+    parser.add_argument('--datasets', type=str, nargs='+', default=None)
+    parser.add_argument('--batch-size', type=int, default=256)
+    parser.add_argument('--shuffle-buffer', type=int, default=0, help='Rows in the shuffle pool (0: sequential)')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--prefetch', type=int, default=2, help='Blocks read ahead in the background')
+    parser.add_argument('--layout', type=str, default='padded', choices=['padded', 'ragged'])
+    parser.add_argument('--mask', action='store_true')
+    args = parser.parse_args()
+    start, nrows, nbatches, nbytes = time.perf_counter(), 0, 0, 0
+    for batch in iterate_batches(args.inpfile, args.batch_size, args.datasets, args.shuffle_buffer, args.seed,
+                                 args.prefetch, args.layout, mask=args.mask):
+        nbatches += 1
+        nrows += ([len(d)-1 for n, d in batch.items() if n.endswith('_offsets')]
+                  or [len(d) for n, d in batch.items()])[0]
+        nbytes += sum(data.nbytes for data in batch.values())
+    wall = time.perf_counter()-start
+    print('{} batches, {} rows in {:.2f} s: {:.0f} rows/s, {:.1f} MB/s'.format(nbatches, nrows, wall, nrows/wall,
+                                                                             nbytes/1024**2/wall))
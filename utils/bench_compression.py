@@ -0,0 +1,66 @@
+from __future__ import print_function, division
+import os
+import time
+import argparse
+import tempfile
+import h5py
+from convert_to_h5 import storage_options, create_extendable, append_to_dataset, extendable_datasets
+
+# compressor, level pairs compared by default
+SETTINGS = [('none', None), ('lzf', None), ('gzip', 1), ('gzip', 4), ('lz4', None),
+            ('zstd', 1), ('zstd', 5), ('blosc', 5)]
+
+def copy_datasets(inFile, output_file, names, storage, nrows):
+    '''write the first nrows of each dataset to output_file with the given storage options'''
+    with h5py.File(output_file, 'w') as outFile:
+        for name in names:
+            dataset = create_extendable(outFile, name, inFile[name].shape[1:], inFile[name].dtype, storage)
+            append_to_dataset(dataset, inFile[name][:nrows])
+
+def read_batches(input_file, names, batch_size):
+    '''read every dataset in batches of batch_size rows, as a training dataloader would'''
+    with h5py.File(input_file, 'r') as inFile:
+        for name in names:
+            dataset = inFile[name]
+            for start in range(0, dataset.shape[0], batch_size):
+                dataset[start:start+batch_size]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--inpfile', type=str, required=True, help='Output of convert_to_h5.py')
+    parser.add_argument('--datasets', type=str, nargs='+', default=None,
+                        help='Datasets to benchmark (default: every extendable dataset)')
+    parser.add_argument('--nrows', type=int, default=None, help='Rows of each dataset to use')
+    parser.add_argument('--batch-size', type=int, default=256, help='Events per training batch and per chunk')
+    parser.add_argument('--settings', type=str, nargs='+', default=None,
+                        help='compressor[:level] pairs, e.g. gzip:4 zstd:3 lz4 none')
+    args = parser.parse_args()
+    settings = SETTINGS
+    if args.settings:
+        settings = [(c.split(':')[0], int(c.split(':')[1]) if ':' in c else None) for c in args.settings]
+    with h5py.File(args.inpfile, 'r') as inFile:
+        names = args.datasets or list(extendable_datasets(inFile))
+        # read everything once so the source file is in the page cache for every setting
+        nbytes = sum(inFile[n][:args.nrows].nbytes for n in names)
+        tmpdir = tempfile.mkdtemp()
+        print('{:6s} {:>5s} {:>10s} {:>10s} {:>11s} {:>11s}'.format('codec', 'level', 'MB', 'ratio', 'write MB/s',
+                                                                   'read MB/s'))
+        for compression, level in settings:
+            output_file = os.path.join(tmpdir, '{}_{}.h5'.format(compression, level))
+            try:
+                storage = storage_options(compression, level, args.batch_size)
+            except ImportError as error:
+                print('{:6s} skipped: {}'.format(compression, error))
+                continue
+            start = time.perf_counter()
+            copy_datasets(inFile, output_file, names, storage, args.nrows)
+            write_time = time.perf_counter()-start
+            start = time.perf_counter()
+            read_batches(output_file, names, args.batch_size)
+            read_time = time.perf_counter()-start
+            size = os.path.getsize(output_file)
+            print('{:6s} {:>5s} {:10.1f} {:10.2f} {:11.1f} {:11.1f}'.format(
+                compression, str(level), size/1024**2, nbytes/size, nbytes/1024**2/write_time,
+                nbytes/1024**2/read_time))
+            os.remove(output_file)
+        os.rmdir(tmpdir)
@@ -0,0 +1,203 @@
+from __future__ import print_function, division
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import resource
+import tempfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import awkward as ak
+import uproot
+import h5py
+from convert_to_h5 import DEFAULT_SPEC, CONVERTERS, load_spec, output_size
+
+# mean multiplicity of each collection in the synthetic ntuples, roughly that of the scouting samples
+MULTIPLICITY = {'Jet': 6, 'FatJet': 2, 'Muon': 0.5, 'Photon': 1, 'Electron': 0.5, 'PFcand': 300, 'bPFcand': 50}
+
+# benchmark cases: name -> (outtype, converter options)
+CASES = {
+    'event': ('event', {}),
+    'event-ragged': ('event', {'layout': 'ragged'}),
+    'event-lz4': ('event', {'compression': 'lz4'}),
+    'event-npy': ('event', {'output_format': 'npy'}),
+    'event-pipeline': ('event', {'pipeline_depth': 2}),
+    'event-adaptive': ('event', {'maxn_quantile': 0.999}),
+    'event-features': ('event', {'features': True}),
+    'event-top128': ('event', {'top_k': ['PFcand', 'bPFcand'], 'max_objects': {'PFcand': 128, 'bPFcand': 128}}),
+    'jet': ('jet', {}),
+    'jet-all': ('jet', {'all_jets': True}),
+    'jet-all-ragged': ('jet', {'all_jets': True, 'layout': 'ragged'}),
+    'jet-all-adaptive': ('jet', {'all_jets': True, 'maxn_quantile': 0.999}),
+    'jet-all-top64': ('jet', {'all_jets': True, 'top_k': ['PFcand'], 'max_objects': {'PFcand': 64}}),
+    'jet-all-image': ('jet', {'all_jets': True, 'image_pixels': 40}),
+    'jet-all-knn16': ('jet', {'all_jets': True, 'knn': 16}),
+    'jet-all-relative': ('jet', {'all_jets': True, 'relative': True}),
+    'event-memmap': ('event', {'file_source': 'memmap'}),
+    'jet-memmap': ('jet', {'file_source': 'memmap'}),
+}
+
+def thread_cases(threads):
+    '''cases decompressing and interpreting baskets in thread pools of the given size'''
+    return {'event-threads': ('event', {'decompression_threads': threads, 'interpretation_threads': threads}),
+            'event-decompression-threads': ('event', {'decompression_threads': threads}),
+            'jet-threads': ('jet', {'decompression_threads': threads, 'interpretation_threads': threads})}
+CASES.update(thread_cases(os.cpu_count() or 1))
+
+def spec_collections(spec):
+    '''every collection of the spec, event based, jet based and of the event features'''
+    return (list(spec['event'])+[spec['jet']['jets'], spec['jet']['constituents']]
+            + list(spec.get('event_features', {}).values()))
+
+def random_field(rng, field, collection, n):
+    '''n synthetic float32/int32 values for one field of a collection'''
+    if field == 'pt':
+        return rng.exponential({'FatJet': 300., 'MET': 100.}.get(collection, 10.), n).astype('f4')
+    if field == 'eta':
+        return rng.uniform(-2.5, 2.5, n).astype('f4')
+    if field == 'phi':
+        return rng.uniform(-np.pi, np.pi, n).astype('f4')
+    if field in ('m', 'mass', 'msoftdrop', 'mtrim'):
+        return rng.exponential(5. if collection != 'FatJet' else 80., n).astype('f4')
+    if field == 'pdgid':
+        return rng.choice(np.array([211, -211, 22, 130, 11, -11, 13, -13], dtype='i4'), n)
+    if field == 'fromsuep':
+        return rng.integers(0, 2, n).astype('i4')
+    return rng.uniform(0., 1., n).astype('f4')
+
+def make_ntuple(output_file, nentries, spec_file=DEFAULT_SPEC, tree_name='mmtree/tree', seed=0,
+                basket_size=1000, compression=None):
+    '''write a synthetic ROOT tree with the branches of spec_file and Poisson multiplicities. Collections
+    without a counter share the counter of a collection of the same name or, like MET, are one value per entry.
+    As in the analyzers' trees, the branches of a collection are written as one record with a single counter'''
+    rng = np.random.default_rng(seed)
+    spec = load_spec(spec_file)
+    counts, branches, collection_of = {}, {}, {}
+    counters = {c['name']: c['counter'] for c in spec_collections(spec) if 'counter' in c}
+    for collection in spec_collections(spec):
+        if collection['name'] not in counters:
+            for field, branch in collection['branches'].items():
+                branches.setdefault(branch, random_field(rng, field, collection['name'], nentries))
+            continue
+        counter = counters[collection['name']]
+        if counter not in counts:
+            counts[counter] = rng.poisson(MULTIPLICITY.get(collection['name'], 5), nentries).astype('i4')
+        n = counts[counter]
+        for field, branch in collection['branches'].items():
+            if branch not in branches:
+                branches[branch] = ak.unflatten(random_field(rng, field, collection['name'], n.sum()), n)
+                collection_of[branch] = collection['name']
+    # each constituent belongs to one of the fat jets of its event or to none (-1)
+    jets, constituents = spec['jet']['jets'], spec['jet']['constituents']
+    njets = counts[jets['counter']]
+    ncands = counts[constituents['counter']]
+    owner = np.floor(rng.uniform(0, 1, ncands.sum())*(np.repeat(njets, ncands)+1)).astype('i4')-1
+    owner = ak.unflatten(owner, ncands)
+    if 'jet_index' in constituents:
+        branches[constituents['branches'][constituents['jet_index']]] = owner
+    if 'association' in constituents:
+        order = ak.argsort(owner, stable=True)
+        owned = (owner >= 0)[order]
+        jet, constituent = constituents['association']['jet'], constituents['association']['constituent']
+        branches[jet] = owner[order][owned]
+        branches[constituent] = ak.values_astype(ak.local_index(owner)[order][owned], 'i4')
+        # the pairs are a collection of their own, e.g. FatJetPFCands counted by nFatJetPFCands
+        collection_of[jet] = collection_of[constituent] = jet.split('_')[0]
+        counters[jet.split('_')[0]] = 'n'+jet.split('_')[0]
+    records = {}
+    for branch, name in collection_of.items():
+        records.setdefault(name, {})[branch] = branches.pop(branch)
+    branches.update({name: ak.zip(fields) for name, fields in records.items()})
+    options = {} if compression is None else {'compression': compression}
+    with uproot.recreate(output_file, **options) as outFile:
+        tree = outFile.mktree(tree_name, {name: (array.type.content if isinstance(array, ak.Array) else array.dtype)
+                                          for name, array in branches.items()},
+                              counter_name=counters.get, field_name=lambda name, branch: branch)
+        for start in range(0, nentries, basket_size):
+            tree.extend({name: array[start:start+basket_size] for name, array in branches.items()})
+
+def root_compression(setting):
+    '''uproot compression object from e.g. zlib:1, lzma:9, lz4 or zstd:5'''
+    if setting is None or setting == 'none':
+        return None
+    name, _, level = setting.partition(':')
+    return getattr(uproot, name.upper())(int(level)) if level else getattr(uproot, name.upper())()
+
+def run_case(outtype, input_file, output_file, tree_name, options):
+    '''convert once in this process, return wall time, cpu time and peak RSS in bytes'''
+    start, cpu = time.perf_counter(), time.process_time()
+    CONVERTERS[outtype](input_file, output_file, tree_name, **options)
+    wall, cpu = time.perf_counter()-start, time.process_time()-cpu
+    return wall, cpu, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*1024
+
+def benchmark(input_file, tree_name, cases, workdir, repeat=1, common=None):
+    '''run every case in a fresh process so that peak RSS is measured per case. The speedup of a case is
+    relative to the plain event or jet case of the same run'''
+    nentries = uproot.open(input_file)[tree_name].num_entries
+    input_bytes = os.path.getsize(input_file)
+    context = multiprocessing.get_context('spawn')
+    results = []
+    for name in cases:
+        outtype, options = CASES[name]
+        options = dict(common or {}, **options)
+        output_file = os.path.join(workdir, name+('' if options.get('output_format') == 'npy' else '.h5'))
+        runs = []
+        for _ in range(repeat):
+            with ProcessPoolExecutor(1, mp_context=context) as executor:
+                runs.append(executor.submit(run_case, outtype, input_file, output_file, tree_name, options).result())
+        wall, cpu, rss = min(runs)
+        result = {'case': name, 'outtype': outtype, 'options': options, 'entries': nentries, 'wall_s': wall,
+                  'cpu_s': cpu, 'events_per_s': nentries/wall, 'input_MB_per_s': input_bytes/1024**2/wall,
+                  'output_MB_per_s': output_size(output_file)/1024**2/wall, 'peak_rss_MB': rss/1024**2,
+                  'input_MB': input_bytes/1024**2, 'output_MB': output_size(output_file)/1024**2}
+        results.append(result)
+    baseline = {r['case']: r['wall_s'] for r in results if r['case'] in ('event', 'jet')}
+    for result in results:
+        result['speedup'] = baseline[result['outtype']]/result['wall_s'] if result['outtype'] in baseline else None
+        print('{case:28s} {wall_s:8.2f} s {events_per_s:10.0f} events/s {input_MB_per_s:8.1f} MB/s in '
+              '{output_MB_per_s:8.1f} MB/s out  peak RSS {peak_rss_MB:8.1f} MB'.format(**result)
+              + ('  x{:.2f}'.format(result['speedup']) if result['speedup'] else ''))
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--inpfile', type=str, default=None,
+                        help='Existing ntuple to convert (default: generate a synthetic one from --spec)')
+    parser.add_argument('--treename', type=str, default='mmtree/tree')
+    parser.add_argument('--spec', type=str, default=DEFAULT_SPEC, help='Collection spec of the synthetic ntuple and the converter')
+    parser.add_argument('--nentries', type=int, default=10000, help='Entries of the synthetic ntuple')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--root-compression', type=str, nargs='+', default=['zlib:1'],
+                        help='Compressions of the synthetic ntuple, e.g. zlib:1 lzma:9 lz4 zstd:5 none, '
+                             'every case runs on each')
+    parser.add_argument('--threads', type=int, default=os.cpu_count() or 1,
+                        help='Thread pool size of the *-threads cases')
+    parser.add_argument('--cases', type=str, nargs='+', default=sorted(CASES), choices=sorted(CASES))
+    parser.add_argument('--chunk-size', type=int, default=None, help='Passed to the converter as step_size')
+    parser.add_argument('--repeat', type=int, default=1, help='Runs per case, the fastest is reported')
+    parser.add_argument('--workdir', type=str, default=None, help='Where to write the ntuple and outputs (default: a temporary directory)')
+    parser.add_argument('--json', type=str, default=None, help='Save the results to this JSON file')
+    args = parser.parse_args()
+    CASES.update(thread_cases(args.threads))
+    workdir = args.workdir or tempfile.mkdtemp()
+    runs = []
+    for compression in ([None] if args.inpfile else args.root_compression):
+        input_file = args.inpfile
+        if input_file is None:
+            input_file = os.path.join(workdir, 'synthetic_{}.root'.format(compression.replace(':', '')))
+            start = time.perf_counter()
+            make_ntuple(input_file, args.nentries, args.spec, args.treename, args.seed,
+                        compression=root_compression(compression))
+            print('wrote {} entries to {} in {:.1f} s'.format(args.nentries, input_file, time.perf_counter()-start))
+        common = {'spec_file': args.spec, 'step_size': args.chunk_size}
+        runs.append({'input': input_file, 'root_compression': compression,
+                     'results': benchmark(input_file, args.treename, args.cases, workdir, args.repeat, common)})
+    if args.json:
+        report = {'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'host': socket.gethostname(), 'python': sys.version.split()[0],
+                  'cpus': os.cpu_count(), 'versions': {m.__name__: m.__version__ for m in (np, ak, uproot, h5py)},
+                  'synthetic': args.inpfile is None, 'runs': runs}
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
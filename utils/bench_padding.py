@@ -0,0 +1,68 @@
+from __future__ import print_function, division
+import time
+import argparse
+import tracemalloc
+import numpy as np
+import awkward as ak
+from convert_to_h5 import store_objects_coordinates
+
+def legacy_to_np_array(ak_array, maxN=100, pad=0):
+    '''pad_none/fill_none/to_numpy chain used by the converter before the fused kernel'''
+    return ak.to_numpy(ak.fill_none(ak.pad_none(ak_array,maxN,clip=True,axis=-1),pad))
+
+def legacy_store_objects_coordinates(arrays, nentries, nobj=10, obj='FatJet_'):
+    '''reference implementation of store_objects_coordinates before the fused kernel'''
+    l1Obj_cyl = np.zeros((nentries,nobj,3))
+    l1Obj_cart = np.zeros((nentries,nobj,3))
+    pt = legacy_to_np_array(arrays['{}pt'.format(obj)],maxN=nobj)
+    eta = legacy_to_np_array(arrays['{}eta'.format(obj)],maxN=nobj)
+    phi = legacy_to_np_array(arrays['{}phi'.format(obj)],maxN=nobj)
+    l1Obj_cyl[:,:,0] = pt
+    l1Obj_cyl[:,:,1] = eta
+    l1Obj_cyl[:,:,2] = phi
+    l1Obj_cart[:,:,0] = pt*np.cos(phi)
+    l1Obj_cart[:,:,1] = pt*np.sin(phi)
+    l1Obj_cart[:,:,2] = pt*np.sinh(eta)
+    return l1Obj_cyl, l1Obj_cart
+
+def make_pfcands(nentries, mean=300, seed=0):
+    '''synthetic PF candidates with a Poisson multiplicity, stored as float32 like the ntuples'''
+    rng = np.random.default_rng(seed)
+    counts = rng.poisson(mean, nentries)
+    ntot = counts.sum()
+    return ak.zip({'PFcand_pt': ak.unflatten(rng.exponential(5., ntot).astype('f4'), counts),
+                   'PFcand_eta': ak.unflatten(rng.uniform(-2.5, 2.5, ntot).astype('f4'), counts),
+                   'PFcand_phi': ak.unflatten(rng.uniform(-np.pi, np.pi, ntot).astype('f4'), counts)})
+
+def measure(func, repeat):
+    '''best wall time and peak traced allocation of func()'''
+    times = []
+    for _ in range(repeat):
+        tracemalloc.start()
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter()-start)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return min(times), peak
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--nentries', type=int, default=20000)
+    parser.add_argument('--mean', type=float, default=300, help='Mean PF candidate multiplicity')
+    parser.add_argument('--maxN', type=int, default=1000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+    arrays = make_pfcands(args.nentries, args.mean)
+    n = args.nentries
+    legacy = legacy_store_objects_coordinates(arrays, n, nobj=args.maxN, obj='PFcand_')
+    fused = store_objects_coordinates(arrays, n, nobj=args.maxN, obj='PFcand_')
+    assert all(np.array_equal(a, b) for a, b in zip(legacy, fused)), 'fused kernel differs from the legacy path'
+    del legacy, fused
+    cases = [('legacy', lambda: legacy_store_objects_coordinates(arrays, n, nobj=args.maxN, obj='PFcand_')),
+             ('fused', lambda: store_objects_coordinates(arrays, n, nobj=args.maxN, obj='PFcand_')),
+             ('fused float32', lambda: store_objects_coordinates(arrays, n, nobj=args.maxN, obj='PFcand_', dtype='f4')),
+             ('fused ragged', lambda: store_objects_coordinates(arrays, n, nobj=args.maxN, obj='PFcand_', layout='ragged'))]
+    for name, func in cases:
+        wall, peak = measure(func, args.repeat)
+        print('{:15s} {:8.3f} s {:10.0f} events/s  peak alloc {:8.1f} MB'.format(name, wall, n/wall, peak/1024**2))
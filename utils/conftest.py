@@ -0,0 +1,14 @@
+from __future__ import print_function, division
+import os
+import pytest
+from convert_to_h5 import DEFAULT_SPEC
+from bench_convert import make_ntuple
+
+MINIAOD_SPEC = os.path.join(os.path.dirname(DEFAULT_SPEC), 'scoutingnano_miniaod.json')
+
+@pytest.fixture(scope='module', params=[DEFAULT_SPEC, MINIAOD_SPEC], ids=['legacy', 'miniaod'])
+def ntuple(request, tmp_path_factory):
+    '''(path, spec file) of a small synthetic ntuple in mmtree/tree, one basket every 50 entries'''
+    path = str(tmp_path_factory.mktemp('ntuple')/'ntuple.root')
+    make_ntuple(path, 200, spec_file=request.param, basket_size=50)
+    return path, request.param
@@ -1,186 +1,1614 @@
 from __future__ import print_function, division
 import os
+import glob
+import json
+import time
+import shutil
+import queue
 import argparse
+import resource
+import threading
+import contextlib
+import functools
+from concurrent.futures import ProcessPoolExecutor
 import uproot
 import numpy as np
 import h5py
 import awkward as ak
+try:
+    # registers the lz4, zstd and blosc filters for writing and reading
+    import hdf5plugin
+except ImportError:
+    hdf5plugin = None
+from feature_stats import update_stats, read_stats, write_stats
+from npy_output import NpyDirectory
 
-def to_np_array(ak_array, maxN=100, pad=0):
-    '''convert awkward array to regular numpy array'''
-    return ak.to_numpy(ak.fill_none(ak.pad_none(ak_array,maxN,clip=True,axis=-1),pad))
+# collection spec matching the branch names the converter has always used
+DEFAULT_SPEC = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'specs', 'flatscouting_legacy.json')
 
-def store_objects_coordinates(arrays, nentries, nobj=10, obj='FatJet_'):
+# output dtype of each kind of dataset; 'double' reproduces the historical float64 output.
+# 'half' is lossy: ROOT Float16_t without a range keeps 12 mantissa bits, IEEE half only 10,
+# and it applies to the kinematics of every collection, including the derived px/py/pz
+PRECISIONS = {
+    'double': {'kinematics': 'f8', 'features': 'f8', 'ids': 'f8', 'truth': 'f8'},
+    'single': {'kinematics': 'f4', 'features': 'f4', 'ids': 'i2', 'truth': 'u1'},
+    'half': {'kinematics': 'f2', 'features': 'f4', 'ids': 'i2', 'truth': 'u1'},
+}
+
+def padding_index(ak_array, maxN=100, layout='padded'):
+    '''destination row of every object in a flat (nentries*maxN) output buffer, and the mask
+    of objects within maxN. The ragged layout keeps objects in storage order, so no index is needed'''
+    counts = ak.to_numpy(ak.num(ak_array, axis=1))
+    cols = np.arange(counts.sum()) - np.repeat(np.cumsum(counts)-counts, counts)
+    keep = cols < maxN
+    if layout == 'ragged':
+        return slice(None), keep
+    return np.repeat(np.arange(len(counts))*maxN, counts)[keep] + cols[keep], keep
+
+def flat_values(ak_array, keep, dtype=None):
+    '''flat content of the objects selected by padding_index'''
+    values = ak.to_numpy(ak.flatten(ak_array, axis=1))
+    if dtype is not None:
+        values = values.astype(dtype, copy=False)
+    return values if keep.all() else values[keep]
+
+def allocate_objects(nentries, nobj, keep, width, dtype='f8', layout='padded'):
+    '''zeroed output buffer with one row per object slot'''
+    nrows = int(keep.sum()) if layout == 'ragged' else nentries*nobj
+    return np.zeros((nrows, width), dtype=dtype)
+
+def shape_objects(buffer, nentries, nobj, layout='padded'):
+    '''view a flat output buffer as (nentries, nobj, width) for the padded layout'''
+    if layout == 'ragged':
+        return buffer
+    return buffer.reshape(nentries, nobj, buffer.shape[-1])
+
+def compute_dtype(dtype):
+    '''floating point type used for the coordinate math before storing as dtype'''
+    return np.result_type(dtype, np.float32)
+
+def delta_phi(phi1, phi2):
+    '''phi1-phi2 wrapped into [-pi, pi)'''
+    return (phi1-phi2+np.pi) % (2*np.pi) - np.pi
+
+# uproot sources of --file-source, default lets uproot choose from the path
+FILE_SOURCES = {'default': None, 'memmap': 'MemmapSource', 'threaded': 'MultithreadedFileSource',
+                'fsspec': 'FSSpecSource'}
+
+def open_input(input_file, file_source=None, decompression_threads=None, interpretation_threads=None):
+    '''open a ROOT file with the given uproot source and thread pools decompressing and interpreting
+    baskets. The pools belong to the file and are shut down when it is closed'''
+    options = {}
+    if FILE_SOURCES.get(file_source):
+        options['handler'] = getattr(uproot, FILE_SOURCES[file_source])
+    if decompression_threads:
+        options['decompression_executor'] = uproot.ThreadPoolExecutor(max_workers=decompression_threads)
+    if interpretation_threads:
+        options['interpretation_executor'] = uproot.ThreadPoolExecutor(max_workers=interpretation_threads)
+    try:
+        return uproot.open(input_file, **options)
+    except BaseException:
+        for name in ('decompression_executor', 'interpretation_executor'):
+            if name in options:
+                options[name].shutdown()
+        raise
+
+def peak_rss():
+    '''peak resident set size of this process in bytes'''
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*1024
+
+class Profile(object):
+    '''wall time, CPU time of the running thread and peak RSS of named conversion stages, and the bytes
+    read from the input files and handed to the output datasets'''
+    def __init__(self):
+        self.stages = {}
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        rss, start, cpu = peak_rss(), time.perf_counter(), time.thread_time()
+        try:
+            yield
+        finally:
+            wall, cpu, after = time.perf_counter()-start, time.thread_time()-cpu, peak_rss()
+            self.add(name, {'calls': 1, 'wall_s': wall, 'cpu_s': cpu, 'peak_rss_MB': after/1024**2,
+                            'peak_rss_growth_MB': (after-rss)/1024**2})
+
+    def add(self, name, stage):
+        with self.lock:
+            total = self.stages.setdefault(name, {'calls': 0, 'wall_s': 0., 'cpu_s': 0., 'peak_rss_MB': 0.,
+                                                  'peak_rss_growth_MB': 0.})
+            for key, value in stage.items():
+                total[key] = max(total[key], value) if key == 'peak_rss_MB' else total[key]+value
+
+    def merge(self, report):
+        '''add the stages and bytes of another profile's to_dict(), e.g. of a worker process'''
+        for name, stage in report['stages'].items():
+            self.add(name, stage)
+        with self.lock:
+            self.bytes_read += report['bytes_read']
+            self.bytes_written += report['bytes_written']
+
+    def to_dict(self):
+        return {'stages': self.stages, 'bytes_read': self.bytes_read, 'bytes_written': self.bytes_written}
+
+    def report(self, output_bytes=None):
+        '''print the stages by decreasing wall time and the bytes read and written'''
+        print('{:32s} {:>7s} {:>9s} {:>9s} {:>7s} {:>12s} {:>12s}'.format('stage', 'calls', 'wall s', 'cpu s', 'cpu %',
+                                                                        'peak RSS MB', 'RSS growth'))
+        for name, stage in sorted(self.stages.items(), key=lambda item: -item[1]['wall_s']):
+            print('{:32s} {calls:7d} {wall_s:9.2f} {cpu_s:9.2f} {:7.0f} {peak_rss_MB:12.1f} {peak_rss_growth_MB:12.1f}'.format(
+                name, 100*stage['cpu_s']/max(stage['wall_s'], 1e-9), **stage))
+        print('read {:.1f} MB from the inputs, wrote {:.1f} MB of arrays'.format(self.bytes_read/1024**2,
+                                                                                 self.bytes_written/1024**2)
+              + ('' if output_bytes is None else ', {:.1f} MB on disk'.format(output_bytes/1024**2)))
+
+# profile of the running conversion, set by --profile
+PROFILE = None
+
+def profiled(name):
+    '''time a stage into PROFILE, if profiling'''
+    return PROFILE.stage(name) if PROFILE is not None else contextlib.nullcontext()
+
+def profiled_function(func):
+    '''time every call of func as a stage named after it'''
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with profiled(func.__name__):
+            return func(*args, **kwargs)
+    return wrapper
+
+def profiled_iter(name, iterable):
+    '''time the production of every item of iterable as a stage'''
+    iterator = iter(iterable)
+    while True:
+        if PROFILE is None:
+            item = next(iterator, StopIteration)
+        else:
+            start, cpu, rss = time.perf_counter(), time.thread_time(), peak_rss()
+            item = next(iterator, StopIteration)
+            # the call finding the end of iterable is added to the last item
+            PROFILE.add(name, {'calls': int(item is not StopIteration), 'wall_s': time.perf_counter()-start,
+                               'cpu_s': time.thread_time()-cpu, 'peak_rss_MB': peak_rss()/1024**2,
+                               'peak_rss_growth_MB': (peak_rss()-rss)/1024**2})
+        if item is StopIteration:
+            return
+        yield item
+
+def close_input(inFile):
+    '''close an input file, counting the bytes requested from it'''
+    if PROFILE is not None:
+        with PROFILE.lock:
+            PROFILE.bytes_read += inFile.file.source.num_requested_bytes
+    inFile.close()
+
+def load_spec(spec_file):
+    '''load a collection spec mapping logical collections to tree branches, maxN and dtype'''
+    with open(spec_file) as f:
+        if spec_file.endswith(('.yaml', '.yml')):
+            import yaml
+            return yaml.safe_load(f)
+        return json.load(f)
+
+def collection_branches(collection):
+    '''map logical branch names, <name>_<field>, to the tree branches of one collection'''
+    return {'{}_{}'.format(collection['name'], field): branch for field, branch in collection['branches'].items()}
+
+def check_branches(tree, branches, spec_file):
+    '''fail before any basket is read if the tree lacks branches required by the spec'''
+    missing = sorted(set(branches) - set(tree.keys()))
+    if missing:
+        raise KeyError('{}:{} has no branches {} required by {}'.format(tree.file.file_path, tree.object_path,
+                                                                   ', '.join(missing), spec_file))
+
+def selected_ranges(tree, branches, mask, entry_start=0):
+    '''entry ranges covering the common baskets of branches that hold at least one entry selected by mask'''
+    bounds = np.clip(np.asarray(tree.common_entry_offsets(filter_name=branches)), entry_start, entry_start+len(mask))
+    bounds = np.unique(np.concatenate([[entry_start, entry_start+len(mask)], bounds]))
+    needed = np.add.reduceat(mask, bounds[:-1]-entry_start) > 0 if len(mask) else []
+    ranges = []
+    for start, stop, need in zip(bounds[:-1], bounds[1:], needed):
+        if need and ranges and ranges[-1][1] == start:
+            ranges[-1][1] = int(stop)
+        elif need:
+            ranges.append([int(start), int(stop)])
+    return ranges
+
+def iterate_logical(tree, aliases, step_size, entry_start=None, entry_stop=None, cut=None):
+    '''iterate over chunks reading only the aliased branches, yielding the entry numbers of the chunk and
+    a logical name -> array dict. A cut, in uproot expression syntax, is evaluated first on the branches it
+    uses, then only the baskets holding selected entries are read and the rejected entries dropped'''
+    branches = sorted(set(aliases.values()))
+    entry_start = entry_start or 0
+    entry_stop = tree.num_entries if entry_stop is None else min(entry_stop, tree.num_entries)
+    ranges, mask = [(entry_start, entry_stop)], None
+    if cut:
+        mask = tree.arrays([cut], entry_start=entry_start, entry_stop=entry_stop, library='np')[cut].astype(bool)
+        ranges = selected_ranges(tree, branches, mask, entry_start)
+    for start, stop in ranges:
+        for chunk, report in tree.iterate(branches, step_size=step_size, entry_start=start, entry_stop=stop,
+                                          report=True):
+            entries = np.arange(report.tree_entry_start, report.tree_entry_stop)
+            if mask is not None:
+                keep = mask[entries-entry_start]
+                if not keep.any():
+                    continue
+                chunk, entries = chunk[keep], entries[keep]
+            yield entries, {name: chunk[branch] for name, branch in aliases.items()}
+
+def to_np_array(ak_array, maxN=100, pad=0, layout='padded'):
+    '''convert awkward array to regular numpy array, or to its flat content for the ragged layout'''
+    dest, keep = padding_index(ak_array, maxN, layout)
+    values = flat_values(ak_array, keep)
+    if layout == 'ragged':
+        return values
+    padded = np.full(len(ak_array)*maxN, pad, dtype=values.dtype)
+    padded[dest] = values
+    return padded.reshape(len(ak_array), maxN)
+
+def pt_order(pt):
+    '''per-entry indices ordering objects by decreasing pT, one ragged argsort over the whole chunk'''
+    return ak.argsort(pt, axis=1, ascending=False, stable=True)
+
+def to_counts(ak_array, maxN=100):
+    '''number of objects kept per entry in the ragged layout'''
+    return np.minimum(ak.to_numpy(ak.num(ak_array, axis=1)), maxN).astype('i8')
+
+def ragged_to_padded(values, offsets, maxN=None, pad=0):
+    '''scatter flat values into a zero-padded (nentries, maxN, ...) array using CSR offsets'''
+    counts = np.diff(offsets)
+    if maxN is None:
+        maxN = int(counts.max()) if len(counts) else 0
+    padded = np.full((len(counts), maxN)+values.shape[1:], pad, dtype=values.dtype)
+    rows = np.repeat(np.arange(len(counts)), counts)
+    cols = np.arange(len(values)) - np.repeat(offsets[:-1]-offsets[0], counts)
+    keep = cols < maxN
+    padded[rows[keep], cols[keep]] = values[keep]
+    return padded
+
+def offsets_name(name, group):
+    '''name of the CSR offsets dataset of a ragged dataset in group, or None for per-entry datasets'''
+    for candidate in (name+'_offsets', name.rsplit('_', 1)[0]+'_offsets'):
+        if candidate != name and candidate in group:
+            return candidate
+    return None
+
+def read_padded_batch(inFile, name, start, stop, maxN=None, pad=0):
+    '''read entries [start, stop) of a ragged dataset as a zero-padded batch'''
+    offsets = inFile[offsets_name(name, inFile)][start:stop+1]
+    values = inFile[name][offsets[0]:offsets[-1]]
+    return ragged_to_padded(values, offsets, maxN, pad)
+
+@profiled_function
+def store_objects_coordinates(arrays, nentries, nobj=10, obj='FatJet_', dtype='f8', layout='padded'):
     '''store objects in zero-padded numpy arrays'''
-    l1Obj_cyl = np.zeros((nentries,nobj,3))
-    l1Obj_cart = np.zeros((nentries,nobj,3))
-    pt = to_np_array(arrays['{}pt'.format(obj)],maxN=nobj)
-    eta = to_np_array(arrays['{}eta'.format(obj)],maxN=nobj)
-    phi = to_np_array(arrays['{}phi'.format(obj)],maxN=nobj)
-    l1Obj_cyl[:,:,0] = pt
-    l1Obj_cyl[:,:,1] = eta
-    l1Obj_cyl[:,:,2] = phi
-    l1Obj_cart[:,:,0] = pt*np.cos(phi)
-    l1Obj_cart[:,:,1] = pt*np.sin(phi)
-    l1Obj_cart[:,:,2] = pt*np.sinh(eta)
+    dest, keep = padding_index(arrays['{}pt'.format(obj)], nobj, layout)
+    pt = flat_values(arrays['{}pt'.format(obj)], keep, compute_dtype(dtype))
+    eta = flat_values(arrays['{}eta'.format(obj)], keep, compute_dtype(dtype))
+    phi = flat_values(arrays['{}phi'.format(obj)], keep, compute_dtype(dtype))
+    l1Obj_cyl = allocate_objects(nentries, nobj, keep, 3, dtype, layout)
+    l1Obj_cart = allocate_objects(nentries, nobj, keep, 3, dtype, layout)
+    l1Obj_cyl[dest,0] = pt
+    l1Obj_cyl[dest,1] = eta
+    l1Obj_cyl[dest,2] = phi
+    l1Obj_cart[dest,0] = pt*np.cos(phi)
+    l1Obj_cart[dest,1] = pt*np.sin(phi)
+    l1Obj_cart[dest,2] = pt*np.sinh(eta)
     
-    return l1Obj_cyl, l1Obj_cart
+    return shape_objects(l1Obj_cyl, nentries, nobj, layout), shape_objects(l1Obj_cart, nentries, nobj, layout)
 
-def store_objects_truth(arrays, nentries, nobj=10, obj='FatJet_'):
+@profiled_function
+def store_objects_truth(arrays, nentries, nobj=10, obj='FatJet_', dtype='f8', layout='padded'):
     '''store objects in zero-padded numpy arrays'''
-    l1Obj_truth = np.zeros((nentries,nobj,1))
-    fromsuep = to_np_array(arrays['{}fromsuep'.format(obj)],maxN=nobj)
-    l1Obj_truth[:,:,0] = fromsuep
+    dest, keep = padding_index(arrays['{}fromsuep'.format(obj)], nobj, layout)
+    l1Obj_truth = allocate_objects(nentries, nobj, keep, 1, dtype, layout)
+    l1Obj_truth[dest,0] = flat_values(arrays['{}fromsuep'.format(obj)], keep)
     
-    return l1Obj_truth
+    return shape_objects(l1Obj_truth, nentries, nobj, layout)
 
-def store_objects_addfeatures(arrays, nentries, nobj=10, obj='FatJet_'):
+@profiled_function
+def store_objects_addfeatures(arrays, nentries, nobj=10, obj='FatJet_', dtype='f8', layout='padded',
+                              features=('pdgid', 'fjidx')):
     '''store objects in zero-padded numpy arrays'''
-    l1Obj_features = np.zeros((nentries,nobj,2))
-    pdgid = to_np_array(arrays['{}pdgid'.format(obj)],maxN=nobj)
-    fjidx = to_np_array(arrays['{}fjidx'.format(obj)],maxN=nobj)
-    l1Obj_features[:,:,0] = pdgid
-    l1Obj_features[:,:,1] = fjidx
+    dest, keep = padding_index(arrays['{}{}'.format(obj, features[0])], nobj, layout)
+    l1Obj_features = allocate_objects(nentries, nobj, keep, len(features), dtype, layout)
+    for i, feature in enumerate(features):
+        l1Obj_features[dest,i] = flat_values(arrays['{}{}'.format(obj, feature)], keep)
     
-    return l1Obj_features
+    return shape_objects(l1Obj_features, nentries, nobj, layout)
 
-def store_objects_features(arrays, nentries, nobj=10,obj='FatJet_'):
+@profiled_function
+def store_objects_features(arrays, nentries, nobj=10,obj='FatJet_', dtype='f8', layout='padded'):
     '''store objects in zero-padded numpy arrays'''
     features=arrays.fields
     nfeats = len(arrays.fields)
-    objects = np.zeros((nentries,nobj,nfeats+3)) #+3 for cart. coordinates
+    dest, keep = padding_index(arrays['{}_pt'.format(obj)], nobj, layout)
+    objects = allocate_objects(nentries, nobj, keep, nfeats+3, dtype, layout) #+3 for cart. coordinates
     for i in range(0,nfeats):
-        objects[:,:,i] = to_np_array(arrays['{}'.format(features[i])],maxN=nobj)
+        objects[dest,i] = flat_values(arrays['{}'.format(features[i])], keep)
     #add cartesian coordinates
-    pt = to_np_array(arrays['{}_pt'.format(obj)],maxN=nobj)
-    eta = to_np_array(arrays['{}_eta'.format(obj)],maxN=nobj)
-    phi = to_np_array(arrays['{}_phi'.format(obj)],maxN=nobj)
-    objects[:,:,nfeats] = pt*np.cos(phi) #px
-    objects[:,:,nfeats+1] = pt*np.sin(phi) #py
-    objects[:,:,nfeats+2] = pt*np.sinh(eta) #pz
+    pt = flat_values(arrays['{}_pt'.format(obj)], keep, compute_dtype(dtype))
+    eta = flat_values(arrays['{}_eta'.format(obj)], keep, compute_dtype(dtype))
+    phi = flat_values(arrays['{}_phi'.format(obj)], keep, compute_dtype(dtype))
+    objects[dest,nfeats] = pt*np.cos(phi) #px
+    objects[dest,nfeats+1] = pt*np.sin(phi) #py
+    objects[dest,nfeats+2] = pt*np.sinh(eta) #pz
     features_names = features + ['px','py','pz']
     features_names = [n.encode('utf8') for n in features_names]
-    return objects, features_names
+    return shape_objects(objects, nentries, nobj, layout), features_names
+
+def mass_field(arrays, obj):
+    '''name of the mass field of obj in arrays, None for massless objects'''
+    for field in ('m', 'mass'):
+        if '{}_{}'.format(obj, field) in arrays.fields:
+            return '{}_{}'.format(obj, field)
+    return None
+
+@profiled_function
+def store_objects_relative(arrays, jets, nentries, nobj=10, obj='PFcand', jet='FatJet', dtype='f8', layout='padded'):
+    '''store the objects of every entry relative to the axis of the first jet of the entry in zero-padded
+    numpy arrays: delta eta, delta phi, log(pt/pt_jet), log(E/E_jet) and delta R'''
+    ctype = compute_dtype(dtype)
+    dest, keep = padding_index(arrays['{}_pt'.format(obj)], nobj, layout)
+    row = np.repeat(np.arange(nentries), ak.to_numpy(ak.num(arrays['{}_pt'.format(obj)], axis=1)))[keep]
+    pt = flat_values(arrays['{}_pt'.format(obj)], keep, ctype)
+    eta = flat_values(arrays['{}_eta'.format(obj)], keep, ctype)
+    phi = flat_values(arrays['{}_phi'.format(obj)], keep, ctype)
+    mass = mass_field(arrays, obj)
+    energy = np.sqrt((pt*np.cosh(eta))**2 + (flat_values(arrays[mass], keep, ctype)**2 if mass else 0))
+    # the jet axis broadcast onto the objects of its entry, entries without a jet get 0
+    def first_jet(name):
+        return ak.to_numpy(ak.fill_none(ak.firsts(jets[name]), 0)).astype(ctype)[row]
+    has_jet = (ak.to_numpy(ak.num(jets['{}_pt'.format(jet)], axis=1)) > 0)[row]
+    axis = {field: first_jet('{}_{}'.format(jet, field)) for field in ('pt', 'eta', 'phi')}
+    jet_mass = mass_field(jets, jet)
+    jet_energy = np.sqrt((axis['pt']*np.cosh(axis['eta']))**2 + (first_jet(jet_mass)**2 if jet_mass else 0))
+    objects = allocate_objects(nentries, nobj, keep, 5, dtype, layout)
+    deta = eta - axis['eta']
+    dphi = delta_phi(phi, axis['phi'])
+    objects[dest,0] = deta
+    objects[dest,1] = dphi
+    with np.errstate(divide='ignore', invalid='ignore'):
+        objects[dest,2] = np.where(has_jet, np.log(pt/axis['pt']), 0)
+        objects[dest,3] = np.where(has_jet, np.log(energy/jet_energy), 0)
+    objects[dest,4] = np.hypot(deta, dphi)
+    features_names = [n.encode('utf8') for n in ('deta', 'dphi', 'logptrel', 'logerel', 'deltaR')]
+    return shape_objects(objects, nentries, nobj, layout), features_names
+
+def parse_memory(size):
+    '''convert a memory budget such as 2GB, 500MB or 1048576 to bytes'''
+    units = {'KB': 1024, 'MB': 1024**2, 'GB': 1024**3, 'TB': 1024**4}
+    size = str(size).strip().upper().replace(' ', '')
+    for unit, factor in units.items():
+        if size.endswith(unit):
+            return int(float(size[:-len(unit)])*factor)
+    return int(size.rstrip('B'))
+
+def choose_step_size(tree, varList, out_bytes_per_entry, max_memory=None, step_size=None, pipeline_depth=0):
+    '''number of entries per chunk such that input and output buffers fit in max_memory, shared by
+    the chunks a pipeline keeps in flight'''
+    nentries = tree.num_entries
+    if step_size is not None:
+        return max(1, min(int(step_size), nentries))
+    if max_memory is None:
+        return max(1, nentries)
+    max_memory = parse_memory(max_memory)
+    if pipeline_depth:
+        # one chunk in each of the three stages plus the ones waiting in both queues
+        max_memory //= 3+2*pipeline_depth
+    # the awkward input plus its flat numpy copies
+    in_bytes_per_entry = 2*sum(tree[var].uncompressed_bytes for var in varList)/max(1, nentries)
+    return max(1, min(nentries, int(max_memory//(in_bytes_per_entry+out_bytes_per_entry))))
+
+def scan_branches(tree, branches, entry_start=None, entry_stop=None, cut=None):
+    '''read a few light branches, e.g. counters, of the selected entries in one go. Without any selected
+    entry the arrays are empty but keep the type of the branches, jagged or not'''
+    chunks = [arrays for _, arrays in iterate_logical(tree, {b: b for b in branches}, '100 MB', entry_start,
+                                                      entry_stop, cut)]
+    if not chunks:
+        empty = tree.arrays(branches, entry_start=0, entry_stop=0)
+        return {b: empty[b] for b in branches}
+    return {b: ak.concatenate([arrays[b] for arrays in chunks]) for b in branches}
+
+def event_multiplicity_branches(collections):
+    '''the counter branches event_multiplicities reads'''
+    return sorted(set(c['counter'] for c in collections))
+
+def event_multiplicities(tree, collections, entry_start=None, entry_stop=None, cut=None, scanned=None):
+    '''collection name -> number of objects per entry, from the counter branches only. scanned, if given,
+    holds these branches already read by scan_branches'''
+    counts = scanned or scan_branches(tree, event_multiplicity_branches(collections), entry_start, entry_stop, cut)
+    return {c['name']: ak.to_numpy(counts[c['counter']]) for c in collections}
+
+def jet_multiplicity_branches(jet_spec):
+    '''the jet index or association branch, and the jet counter if any, jet_multiplicities reads'''
+    constituents = jet_spec['constituents']
+    if 'association' in constituents:
+        branch = constituents['association']['jet']
+    else:
+        branch = constituents['branches'][constituents['jet_index']]
+    counter = jet_spec['jets'].get('counter')
+    return [branch]+([counter] if counter else [])
+
+def jet_multiplicities(tree, jet_spec, all_jets=False, entry_start=None, entry_stop=None, cut=None, scanned=None):
+    '''constituent collection name -> number of constituents of the leading jet of every entry or, with
+    all_jets, of every jet, from the jet index or association branch only. scanned, if given, holds these
+    branches already read by scan_branches'''
+    constituents = jet_spec['constituents']
+    branch = jet_multiplicity_branches(jet_spec)[0]
+    counter = jet_spec['jets'].get('counter')
+    branches = scanned or scan_branches(tree, jet_multiplicity_branches(jet_spec), entry_start, entry_stop, cut)
+    jet_idx = branches[branch]
+    if not all_jets:
+        return {constituents['name']: ak.to_numpy(ak.sum(jet_idx == 0, axis=1))}
+    entry = np.repeat(np.arange(len(jet_idx)), ak.to_numpy(ak.num(jet_idx, axis=1)))
+    jet = ak.to_numpy(ak.flatten(jet_idx, axis=1)).astype('i8')
+    if not counter:
+        # only jets with at least one constituent are seen
+        keep = jet >= 0
+        return {constituents['name']: np.unique(entry[keep]*(int(jet.max(initial=0))+1)+jet[keep], return_counts=True)[1]}
+    # one count per jet, indices beyond the jets of the entry are dropped by explode_jets as well
+    njet = ak.to_numpy(branches[counter]).astype('i8')
+    keep = (jet >= 0) & (jet < njet[entry])
+    jet_start = np.cumsum(njet)-njet
+    return {constituents['name']: np.bincount(jet_start[entry[keep]]+jet[keep], minlength=int(njet.sum()))}
+
+# branches read by the multiplicity pre-scan of each output type, from its section of the spec
+MULTIPLICITY_BRANCHES = {'event': event_multiplicity_branches, 'jet': jet_multiplicity_branches}
+
+def adapt_max_objects(multiplicities, quantile):
+    '''maxN of every collection from a quantile of its multiplicity, and a report of the objects
+    and entries truncated by it'''
+    max_objects, report = {}, {}
+    for name, counts in multiplicities.items():
+        maxN = max(1, int(np.ceil(np.quantile(counts, quantile)))) if len(counts) else 1
+        max_objects[name] = maxN
+        report[name] = {'maxN': maxN, 'quantile': quantile, 'objects': int(counts.sum()),
+                        'truncated_objects': int(np.maximum(counts-maxN, 0).sum()),
+                        'truncated_entries': int((counts > maxN).sum()), 'entries': len(counts)}
+        print('{}: maxN {} ({} quantile), {} of {} objects truncated in {} of {} rows'.format(
+            name, maxN, quantile, report[name]['truncated_objects'], report[name]['objects'],
+            report[name]['truncated_entries'], len(counts)))
+    return max_objects, report
+
+def recorded_max_objects(output_file):
+    '''maxN recorded in an existing output, appended chunks must keep the same shapes'''
+    if not os.path.isfile(output_file):
+        return None
+    with h5py.File(output_file, 'r') as outFile:
+        return json.loads(outFile.attrs['maxN']) if 'maxN' in outFile.attrs else None
+
+def with_max_objects(collections, max_objects=None):
+    '''copies of the spec collections with maxN replaced by max_objects[name]'''
+    max_objects = max_objects or {}
+    return [dict(c, maxN=max_objects.get(c['name'], c['maxN'])) for c in collections]
+
+def compression_options(compression='gzip', level=None):
+    '''create_dataset keyword arguments of a compressor, lz4, zstd and blosc need hdf5plugin'''
+    if compression in ('none', None):
+        return {}
+    if compression == 'gzip':
+        return dict(compression='gzip', compression_opts=level)
+    if compression == 'lzf':
+        return dict(compression='lzf')
+    if hdf5plugin is None:
+        raise ImportError('compression {} needs hdf5plugin'.format(compression))
+    if compression == 'lz4':
+        return dict(hdf5plugin.LZ4())
+    if compression == 'zstd':
+        return dict(hdf5plugin.Zstd(clevel=3 if level is None else level))
+    if compression == 'blosc':
+        return dict(hdf5plugin.Blosc(cname='lz4', clevel=5 if level is None else level,
+                                     shuffle=hdf5plugin.Blosc.SHUFFLE))
+    raise ValueError('unknown compression {}'.format(compression))
+
+def storage_options(compression='gzip', compression_level=None, chunk_events=None):
+    '''how extendable datasets are compressed and chunked, chunk_events rows per chunk or h5py auto-chunking'''
+    return dict(compression=compression_options(compression, compression_level), chunk_events=chunk_events)
+
+def create_extendable(outFile, name, shape, dtype='f8', storage=None, chunk_rows=None):
+    '''create an empty dataset that can be extended along the first axis'''
+    storage = storage or storage_options()
+    chunk_rows = chunk_rows or storage['chunk_events']
+    chunks = (max(1, int(chunk_rows)),)+tuple(max(1, n) for n in shape) if chunk_rows else True
+    return outFile.create_dataset(name, shape=(0,)+tuple(shape), maxshape=(None,)+tuple(shape),
+                                  dtype=dtype, chunks=chunks, **storage['compression'])
+
+def extendable_datasets(outFile):
+    '''name -> dataset of the datasets filled chunk by chunk, or stitched from such datasets of shards'''
+    return {name: d for name, d in outFile.items()
+            if isinstance(d, h5py.Dataset) and (d.maxshape[0] is None or d.is_virtual)}
+
+def append_to_dataset(dataset, data):
+    '''append data along the first axis of a resizable dataset'''
+    nrows = dataset.shape[0]
+    dataset.resize(nrows+len(data), axis=0)
+    dataset[nrows:] = data
+
+def open_output(output_file, output_format='h5', append=False):
+    '''open the converter output, an HDF5 file or a directory of memory-mappable .npy arrays'''
+    if output_format == 'npy':
+        if append:
+            raise ValueError('appending is only supported for HDF5 output')
+        return NpyDirectory(output_file)
+    return h5py.File(output_file, 'a' if append else 'w')
+
+def output_size(path):
+    '''bytes of an output file, or of all files of an npy output directory'''
+    if os.path.isdir(path):
+        return sum(os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(path) for f in files)
+    return os.path.getsize(path)
+
+def run_pipeline(chunks, compute, write, depth=0):
+    '''pass every chunk through compute and write. With depth > 0, reading (iterating chunks),
+    compute and write run in a reader thread, the calling thread and a writer thread connected
+    by queues holding at most depth chunks, so I/O overlaps with the NumPy work'''
+    if not depth:
+        for chunk in chunks:
+            write(compute(chunk))
+        return
+    done, stop, errors = object(), threading.Event(), []
+    read_queue, write_queue = queue.Queue(depth), queue.Queue(depth)
+
+    def put(q, item):
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def get(q):
+        while True:
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                if stop.is_set():
+                    return done
 
-def convert_event_based(input_file, output_file, tree_name):
-    inFile = uproot.open(input_file)
-    l1Tree = inFile[tree_name]
-    nentries = l1Tree.num_entries
+    def reader():
+        try:
+            for chunk in chunks:
+                if not put(read_queue, chunk):
+                    return
+            put(read_queue, done)
+        except BaseException as error:
+            errors.append(error)
+            stop.set()
 
-    # save up to n objects (jets, muons, electrons)
-    njets = 20
-    nfatjets = 10
-    nmuons = 6
-    nelectrons = 6
-    nphotons = 20
-    npfcands=1000
+    def writer():
+        try:
+            for item in iter(lambda: get(write_queue), done):
+                write(item)
+        except BaseException as error:
+            errors.append(error)
+            stop.set()
 
+    threads = [threading.Thread(target=reader), threading.Thread(target=writer)]
+    for thread in threads:
+        thread.start()
+    try:
+        for chunk in iter(lambda: get(read_queue), done):
+            if not put(write_queue, compute(chunk)):
+                break
+        put(write_queue, done)
+    except BaseException:
+        stop.set()
+        raise
+    finally:
+        for thread in threads:
+            thread.join()
+    if errors:
+        raise errors[0]
+
+def write_chunk(outFile, outputs, storage=None):
+    '''append a dict of per-entry arrays, creating the datasets on the first chunk.
+    Datasets named *_offsets receive per-entry counts and are stored as CSR offsets starting at 0'''
+    storage = storage or storage_options()
+    for name, data in outputs.items():
+        if name not in outFile:
+            chunk_rows = None
+            counts = offsets_name(name, outputs)
+            if counts and storage['chunk_events']:
+                # flat ragged values: as many rows per chunk as chunk_events entries hold on average
+                chunk_rows = storage['chunk_events']*max(1., len(data)/max(1, len(outputs[counts])))
+            create_extendable(outFile, name, data.shape[1:], data.dtype, storage, chunk_rows)
+            if name.endswith('_offsets'):
+                append_to_dataset(outFile[name], np.zeros(1, dtype='i8'))
+        with profiled('write '+name):
+            if name.endswith('_offsets'):
+                data = outFile[name][-1] + np.cumsum(data, dtype='i8')
+            append_to_dataset(outFile[name], data)
+        if PROFILE is not None:
+            with PROFILE.lock:
+                PROFILE.bytes_written += data.nbytes
+
+def event_based_aliases(collections):
+    '''logical names of all branches read in event based mode'''
+    aliases = {}
+    for collection in collections:
+        aliases.update(collection_branches(collection))
+    return aliases
+
+@profiled_function
+def event_features(arrays, features_spec, dtype='f4'):
+    '''high level features of every entry of a chunk and their names: HT, the scalar pt sum of the jets,
+    and from the two highest pt fat jets their invariant mass mjj and |delta eta|. With a met collection
+    also MET, the transverse mass MT of the dijet system and MET, the |delta phi| of both fat jets to MET
+    and the smallest of them. Features of missing fat jets are 0'''
+    jets, fatjets, met = features_spec['jets']['name'], features_spec['fatjets']['name'], features_spec.get('met')
+    columns = {'HT': ak.to_numpy(ak.sum(ak.values_astype(arrays[jets+'_pt'], 'f8'), axis=1))}
+    order = pt_order(arrays[fatjets+'_pt'])
+    njets = ak.to_numpy(ak.num(arrays[fatjets+'_pt'], axis=1))
+    leading = {}
+    for field in ('pt', 'eta', 'phi', 'mass'):
+        name = '{}_{}'.format(fatjets, field)
+        values = arrays[name][order] if name in arrays else ak.zeros_like(arrays[fatjets+'_pt'])
+        # the first two fat jets of every entry as (nentries, 2), 0 for missing ones
+        leading[field] = to_np_array(values, 2).astype('f8')
+    px = leading['pt']*np.cos(leading['phi'])
+    py = leading['pt']*np.sin(leading['phi'])
+    pz = leading['pt']*np.sinh(leading['eta'])
+    energy = np.sqrt(px**2+py**2+pz**2+leading['mass']**2)
+    pair = njets >= 2
+    jj = {'px': px.sum(axis=1), 'py': py.sum(axis=1), 'pz': pz.sum(axis=1), 'energy': energy.sum(axis=1)}
+    mjj = np.sqrt(np.maximum(jj['energy']**2-jj['px']**2-jj['py']**2-jj['pz']**2, 0))
+    columns['mjj'] = np.where(pair, mjj, 0)
+    columns['deta_jj'] = np.where(pair, np.abs(leading['eta'][:,0]-leading['eta'][:,1]), 0)
+    if met:
+        met_pt = ak.to_numpy(arrays[met['name']+'_pt']).astype('f8')
+        met_phi = ak.to_numpy(arrays[met['name']+'_phi']).astype('f8')
+        columns['MET'] = met_pt
+        # transverse mass of the dijet system and MET
+        et_jj = np.sqrt(mjj**2 + jj['px']**2 + jj['py']**2)
+        mt2 = (et_jj+met_pt)**2 - (jj['px']+met_pt*np.cos(met_phi))**2 - (jj['py']+met_pt*np.sin(met_phi))**2
+        columns['MT'] = np.where(pair, np.sqrt(np.maximum(mt2, 0)), 0)
+        dphi = np.where(np.arange(2) < njets[:,None], np.abs(delta_phi(leading['phi'], met_phi[:,None])), np.inf)
+        columns['dphi_j1_met'] = np.where(njets >= 1, dphi[:,0], 0)
+        columns['dphi_j2_met'] = np.where(pair, dphi[:,1], 0)
+        columns['dphi_min_met'] = np.where(njets >= 1, dphi.min(axis=1), 0)
+    names = list(columns)
+    return np.stack([columns[name] for name in names], axis=1).astype(dtype), [n.encode('utf8') for n in names]
+
+def event_based_outputs(arrays, nentries, collections, dtypes, layout='padded', counts=None, top_k=()):
+    '''compute the event based datasets for one chunk of entries. counts, if given, is filled with the
+    number of objects per entry of the kinematic datasets. Collections named in top_k keep their
+    maxN highest pT objects instead of the first maxN'''
+    outputs = {}
+    for collection in collections:
+        obj, name, nobj = collection['name']+'_', collection['output'], collection['maxN']
+        if collection['name'] in top_k:
+            order = pt_order(arrays['{}pt'.format(obj)])
+            for field in collection['branches']:
+                arrays[obj+field] = arrays[obj+field][order]
+        outputs[name+'_cyl'], outputs[name+'_cart'] = store_objects_coordinates(arrays, nentries, nobj=nobj, obj=obj,
+                                                                                dtype=collection.get('dtype', dtypes['kinematics']),
+                                                                                layout=layout)
+        ids = [f for f in ('pdgid', 'fjidx') if f in collection['branches']]
+        if ids:
+            outputs[name+'_feat'] = store_objects_addfeatures(arrays, nentries, nobj=nobj, obj=obj, dtype=dtypes['ids'],
+                                                              layout=layout, features=ids)
+        if 'fromsuep' in collection['branches']:
+            outputs[name+'_truth'] = store_objects_truth(arrays, nentries, nobj=nobj, obj=obj, dtype=dtypes['truth'],
+                                                         layout=layout)
+        if layout == 'ragged' or counts is not None:
+            nobjects = to_counts(arrays['{}pt'.format(obj)], maxN=nobj)
+        if layout == 'ragged':
+            outputs[name+'_offsets'] = nobjects
+        if counts is not None:
+            counts[name+'_cyl'] = counts[name+'_cart'] = nobjects
+    return outputs
+
+def plan_event_based(l1Tree, output_file, entry_start=None, entry_stop=None, precision='single', layout='padded',
+                     spec_file=DEFAULT_SPEC, cut=None, append=False, stats=False, maxn_quantile=None,
+                     max_objects=None, top_k=(), features=False, scanned=None):
+    '''event based conversion into one output, see run_conversions. With features, the EventFeatures
+    dataset holds the high level features of the event_features section of the spec. scanned holds the
+    counter branches if convert_multi already read them for maxn_quantile'''
+    dtypes = PRECISIONS[precision]
+
+    # save up to maxN objects of each collection (jets, muons, electrons, ...)
+    spec = load_spec(spec_file)
+    collections = spec['event']
+    features_spec = None
+    if features:
+        if 'event_features' not in spec:
+            raise KeyError('{} has no event_features section'.format(spec_file))
+        features_spec = spec['event_features']
+    truncation = None
+    if append and max_objects is None:
+        max_objects = recorded_max_objects(output_file)
+    if max_objects is None and maxn_quantile is not None:
+        # pick maxN from the counter branches before reading anything heavy
+        check_branches(l1Tree, event_multiplicity_branches(collections), spec_file)
+        with profiled('scan multiplicities'):
+            multiplicities = event_multiplicities(l1Tree, collections, entry_start, entry_stop, cut, scanned)
+        max_objects, truncation = adapt_max_objects(multiplicities, maxn_quantile)
+    collections = with_max_objects(collections, max_objects)
     
     cylNames = [b'pt', b'eta', b'phi']
     cartNames = [b'px', b'py', b'pz']
 
     # variables to retrieve
-    varList = ['n_jet','n_fatjet','n_pho',
-               'n_ele', 'n_mu', 'n_pfcand', 'n_bpfcand']
-    common_prop = ['pt','eta','phi']
-    varList += ['Electron_'+p for p in common_prop+['m']]
-    varList += ['Photon_'+p for p in common_prop+['m']]
-    varList += ['Muon_'+p for p in common_prop+['m']]
-    varList += ['Jet_'+p for p in common_prop+['m']]
-    varList += ['FatJet_'+p for p in common_prop+['mass','msoftdrop', 'mtrim']]
-    varList += ['PFcand_'+p for p in common_prop+['m','pdgid','fjidx','fromsuep']]
-    varList += ['bPFcand_'+p for p in common_prop+['m']]
-
-
-    # get awkward arrays
-    arrays = l1Tree.arrays(varList)
-
-    # store objects: jets, muons, electrons
-    l1Jet_cyl, l1Jet_cart = store_objects_coordinates(arrays, nentries, nobj=njets, obj='Jet_')
-    l1FatJet_cyl, l1FatJet_cart = store_objects_coordinates(arrays, nentries, nobj=nfatjets, obj='FatJet_')
-    l1mu_cyl, l1mu_cart = store_objects_coordinates(arrays, nentries, nobj=nmuons, obj='Muon_')
-    l1pho_cyl, l1pho_cart = store_objects_coordinates(arrays, nentries, nobj=nphotons, obj='Photon_')
-    l1ele_cyl, l1ele_cart = store_objects_coordinates(arrays, nentries, nobj=nelectrons, obj='Electron_')
-    l1pfcand_cyl, l1pfcand_cart = store_objects_coordinates(arrays, nentries, nobj=npfcands, obj='PFcand_')
-    l1pfcand_feat = store_objects_addfeatures(arrays, nentries, nobj=npfcands, obj='PFcand_')
-    l1pfcand_truth = store_objects_truth(arrays, nentries, nobj=npfcands, obj='PFcand_')
-    l1bpfcand_cyl, l1bpfcand_cart = store_objects_coordinates(arrays, nentries, nobj=npfcands, obj='bPFcand_')
+    aliases = event_based_aliases(collections)
+    if features_spec:
+        aliases.update(event_based_aliases(features_spec.values()))
+    check_branches(l1Tree, sorted(set(aliases.values())), spec_file)
 
-    
-    with h5py.File(output_file, 'w') as outFile:
-        outFile.create_dataset('FeatureNames_cyl', data=cylNames, compression='gzip')
-        outFile.create_dataset('FeatureNames_cart', data=cartNames, compression='gzip')
-        outFile.create_dataset('Jet_cyl', data=l1Jet_cyl, compression='gzip')
-        outFile.create_dataset('Jet_cart', data=l1Jet_cart, compression='gzip')
-        outFile.create_dataset('FatJet_cyl', data=l1FatJet_cyl, compression='gzip')
-        outFile.create_dataset('FatJet_cart', data=l1FatJet_cart, compression='gzip')
-        outFile.create_dataset('Muon_cyl', data=l1mu_cyl, compression='gzip')
-        outFile.create_dataset('Muon_cart', data=l1mu_cart, compression='gzip')
-        outFile.create_dataset('Ele_cyl', data=l1ele_cyl, compression='gzip')
-        outFile.create_dataset('Ele_cart', data=l1ele_cart, compression='gzip')
-        outFile.create_dataset('Pho_cyl', data=l1pho_cyl, compression='gzip')
-        outFile.create_dataset('Pho_cart', data=l1pho_cart, compression='gzip')
-        outFile.create_dataset('Pfcand_cyl', data=l1pfcand_cyl, compression='gzip')
-        outFile.create_dataset('Pfcand_cart', data=l1pfcand_cart, compression='gzip')
-        outFile.create_dataset('Pfcand_feat', data=l1pfcand_feat, compression='gzip')
-        outFile.create_dataset('Pfcand_truth', data=l1pfcand_truth, compression='gzip')
-        outFile.create_dataset('bPfcand_cyl', data=l1bpfcand_cyl, compression='gzip')
-        outFile.create_dataset('bPfcand_cart', data=l1bpfcand_cart, compression='gzip')
-
-def convert_jet_based(input_file, output_file, tree_name):
-    inFile = uproot.open(input_file)
-    l1Tree = inFile[tree_name]
-    nentries = l1Tree.num_entries
-
-    jetFeatureNames = ['area','n2b1','n3b1','tau1','tau2','tau3','tau4','mass','msoftdrop','mtrim']
-    particleFeatureNames = ['pdgid','fjidx'] 
-    common_prop = ['pt','eta','phi']
-    jetFeatureNames += [p for p in common_prop]
-    particleFeatureNames += [p for p in common_prop]
+    # cyl + cart for every collection, plus the PF candidate features and truth
+    out_bytes_per_entry = 0
+    for collection in collections:
+        fields = collection['branches']
+        out_bytes_per_entry += collection['maxN']*(
+            6*np.dtype(collection.get('dtype', dtypes['kinematics'])).itemsize
+            + np.dtype(dtypes['ids']).itemsize*len([f for f in ('pdgid', 'fjidx') if f in fields])
+            + np.dtype(dtypes['truth']).itemsize*('fromsuep' in fields))
+    if features_spec:
+        out_bytes_per_entry += 8*np.dtype(dtypes['features']).itemsize
 
-    # variables to retrieve
-    varList = ['n_pfcand','n_fatjet']
-    varJets = ['FatJet_'+p for p in jetFeatureNames]
-    varJets += ['n_fatjet']
-    varPfcands = ['PFcand_'+p for p in particleFeatureNames+['m']]
-    varList+=varJets
-    varList+=varPfcands
-    
-    # get awkward arrays
-    arrays = l1Tree.arrays(varList)    
+    def start(outFile):
+        outFile.attrs['layout'] = layout
+        outFile.attrs['maxN'] = json.dumps({c['name']: c['maxN'] for c in collections})
+        if top_k:
+            outFile.attrs['top_k'] = json.dumps(sorted(top_k))
+        if truncation:
+            outFile.attrs['truncation'] = json.dumps(truncation)
+        if cut:
+            outFile.attrs['cut'] = cut
+        # the pt column of the cyl dataset tells real objects from padding in every dataset of a collection
+        outFile.attrs['padding_reference'] = json.dumps({c['output']+suffix: [c['output']+'_cyl', 0] for c in collections
+                                                         for suffix in ('_cyl', '_cart', '_feat', '_truth')})
+        if 'FeatureNames_cyl' not in outFile:
+            outFile.create_dataset('FeatureNames_cyl', data=cylNames, compression='gzip')
+            outFile.create_dataset('FeatureNames_cart', data=cartNames, compression='gzip')
+
+    accumulated = {}
+    def compute(entries, arrays):
+        counts = {} if stats else None
+        with profiled('compute event'):
+            feature_names = None
+            if features_spec:
+                # before top_k reorders some fields of the collections
+                features, feature_names = event_features(arrays, features_spec, dtypes['features'])
+            outputs = event_based_outputs(arrays, len(entries), collections, dtypes, layout, counts, top_k)
+            if features_spec:
+                outputs['EventFeatures'] = features
+                if counts is not None:
+                    counts['EventFeatures'] = None
+        if stats:
+            with profiled('stats'):
+                update_stats(accumulated, outputs, counts)
+        return outputs, feature_names
+
+    def write(outFile, computed, storage):
+        outputs, feature_names = computed
+        if feature_names and 'EventFeatureNames' not in outFile:
+            outFile.create_dataset('EventFeatureNames', data=feature_names, compression='gzip')
+        write_chunk(outFile, outputs, storage)
+
+    def finish(outFile):
+        if stats:
+            write_stats(outFile, accumulated, append)
+
+    return {'aliases': aliases, 'out_bytes_per_entry': out_bytes_per_entry, 'start': start, 'compute': compute,
+            'write': write, 'finish': finish}
+
+def convert_event_based(input_file, output_file, tree_name, step_size=None, max_memory=None,
+                        entry_start=None, entry_stop=None, precision='single', layout='padded',
+                        spec_file=DEFAULT_SPEC, compression='gzip', compression_level=None, chunk_events=None,
+                        cut=None, output_format='h5', append=False, pipeline_depth=0, stats=False,
+                        maxn_quantile=None, max_objects=None, top_k=(), file_source=None,
+                        decompression_threads=None, interpretation_threads=None, features=False):
+    convert_multi(input_file, [('event', output_file, {'features': features})], tree_name, step_size=step_size, max_memory=max_memory,
+                  entry_start=entry_start, entry_stop=entry_stop, compression=compression,
+                  compression_level=compression_level, chunk_events=chunk_events, cut=cut, output_format=output_format,
+                  append=append, pipeline_depth=pipeline_depth, file_source=file_source,
+                  decompression_threads=decompression_threads, interpretation_threads=interpretation_threads,
+                  precision=precision, layout=layout, spec_file=spec_file, stats=stats, maxn_quantile=maxn_quantile,
+                  max_objects=max_objects, top_k=top_k)
 
+def jet_based_names(jet_spec):
+    '''logical names of the jet and constituent features, the jet counter is stored as the last jet feature'''
+    varJets = list(collection_branches(jet_spec['jets']))
+    if 'counter' in jet_spec['jets']:
+        varJets += [jet_spec['jets']['counter']]
+    varPfcands = list(collection_branches(jet_spec['constituents']))
+    return varJets, varPfcands
+
+def jet_based_aliases(jet_spec):
+    '''logical names of all branches read in jet based mode, counters and association branches keep their names'''
+    jets, constituents = jet_spec['jets'], jet_spec['constituents']
+    if 'jet_index' not in constituents and 'association' not in constituents:
+        raise KeyError('collection spec does not associate constituents to jets')
+    aliases = collection_branches(jets)
+    aliases.update(collection_branches(constituents))
+    if 'counter' in jets:
+        aliases[jets['counter']] = jets['counter']
+    for branch in constituents.get('association', {}).values():
+        aliases[branch] = branch
+    return aliases
+
+def constituent_pairs(arrays, constituents):
+    '''jagged (jet index, constituent index) pairs of every event, from a jet-constituent association
+    or from a per-constituent jet index'''
+    if 'association' in constituents:
+        return arrays[constituents['association']['jet']], arrays[constituents['association']['constituent']]
+    jet_index = arrays['{}_{}'.format(constituents['name'], constituents['jet_index'])]
+    return jet_index, ak.local_index(jet_index)
+
+def explode_jets(jets, pfcands, jet_idx, cand_idx):
+    '''one row per jet of every event, with its constituents gathered through the index pairs.
+    Returns the jets (one per row), their constituents and the (entry, jet) origin of every row'''
+    nentries = len(jets)
+    njet = ak.to_numpy(ak.num(jets, axis=1)).astype('i8')
+    ncand = ak.to_numpy(ak.num(pfcands, axis=1)).astype('i8')
+    jet_start = np.cumsum(njet)-njet
+    cand_start = np.cumsum(ncand)-ncand
+    pair_event = np.repeat(np.arange(nentries), ak.to_numpy(ak.num(jet_idx, axis=1)))
+    pair_jet = ak.to_numpy(ak.flatten(jet_idx, axis=1)).astype('i8')
+    pair_cand = ak.to_numpy(ak.flatten(cand_idx, axis=1)).astype('i8')
+    valid = ((pair_jet >= 0) & (pair_jet < njet[pair_event])
+             & (pair_cand >= 0) & (pair_cand < ncand[pair_event]))
+    jet_row = (jet_start[pair_event] + pair_jet)[valid]
+    cand_row = (cand_start[pair_event] + pair_cand)[valid]
+    order = np.argsort(jet_row, kind='stable')
+    jet_pfcands = ak.unflatten(ak.flatten(pfcands, axis=1)[cand_row[order]],
+                               np.bincount(jet_row, minlength=int(njet.sum())))
+    origin = np.stack([np.repeat(np.arange(nentries), njet),
+                       np.arange(int(njet.sum())) - np.repeat(jet_start, njet)], axis=1)
+    return ak.unflatten(ak.flatten(jets, axis=1), 1), jet_pfcands, origin
+
+def jet_images(jets, pfcands, jet_name, cand_name, npixels=40, radius=0.8, dtype='f4'):
+    '''pT-weighted (nrows, 1, npixels, npixels) images in (delta eta, delta phi) of the constituents of
+    every row, centred on the axis of the first jet of the row and covering [-radius, radius) on both
+    axes. Rows without a jet get an empty image. All constituents of the chunk are histogrammed by one
+    bincount over a combined row/pixel index'''
+    nrows = len(pfcands)
+    has_jet = ak.to_numpy(ak.num(jets[jet_name+'_pt'], axis=1)) > 0
+    jet_eta = ak.to_numpy(ak.fill_none(ak.firsts(jets[jet_name+'_eta']), 0)).astype('f8')
+    jet_phi = ak.to_numpy(ak.fill_none(ak.firsts(jets[jet_name+'_phi']), 0)).astype('f8')
+    row = np.repeat(np.arange(nrows), ak.to_numpy(ak.num(pfcands[cand_name+'_pt'], axis=1)))
+    pt = ak.to_numpy(ak.flatten(pfcands[cand_name+'_pt'])).astype('f8')
+    ieta = np.floor((ak.to_numpy(ak.flatten(pfcands[cand_name+'_eta']))-jet_eta[row]+radius)*npixels/(2*radius))
+    iphi = np.floor((delta_phi(ak.to_numpy(ak.flatten(pfcands[cand_name+'_phi'])), jet_phi[row])+radius)
+                    *npixels/(2*radius))
+    inside = has_jet[row] & (ieta >= 0) & (ieta < npixels) & (iphi >= 0) & (iphi < npixels)
+    pixel = (row*npixels + ieta.astype('i8'))*npixels + iphi.astype('i8')
+    images = np.bincount(pixel[inside], weights=pt[inside], minlength=nrows*npixels*npixels)
+    return images.astype(dtype).reshape(nrows, 1, npixels, npixels)
+
+def knn_edges(eta, phi, counts, k=16, block_pairs=2**22):
+    '''int16 indices of the k nearest neighbours in (eta, phi), delta phi wrapped, of every object of
+    (nrows, maxN) padded coordinates whose first counts[i] objects are real, nearest first. Objects are
+    never their own neighbour nor that of padding, missing neighbours and padding objects get -1.
+    Rows are processed in blocks of about block_pairs distances'''
+    nrows, maxN = eta.shape
+    edges = np.full((nrows, maxN, k), -1, dtype='i2')
+    counts = np.asarray(counts)
+    valid = np.arange(maxN) < counts[:,None]
+    nearest_k = min(k, maxN-1)
+    if nearest_k < 1:
+        return edges
+    step = max(1, block_pairs//(maxN*maxN))
+    for start in range(0, nrows, step):
+        rows = slice(start, start+step)
+        # objects beyond the largest count of the block are padding in every row
+        width = int(np.max(counts[rows], initial=0))
+        if width < 2:
+            continue
+        kth = min(nearest_k, width-1)
+        eta_b, phi_b, diagonal = eta[rows,:width], phi[rows,:width], np.arange(width)
+        pairs = valid[rows,:width,None] & valid[rows,None,:width]
+        pairs[:,diagonal,diagonal] = False
+        d2 = (eta_b[:,:,None]-eta_b[:,None,:])**2 + delta_phi(phi_b[:,:,None], phi_b[:,None,:])**2
+        d2[~pairs] = np.inf
+        nearest = np.argpartition(d2, kth-1, axis=-1)[...,:kth]
+        distance = np.take_along_axis(d2, nearest, axis=-1)
+        order = np.argsort(distance, axis=-1, kind='stable')
+        nearest = np.take_along_axis(nearest, order, axis=-1)
+        edges[rows,:width,:kth] = np.where(np.isfinite(np.take_along_axis(distance, order, axis=-1)), nearest, -1)
+    return edges
+
+def jet_based_outputs(arrays, nentries, jet_spec, dtypes, layout='padded', all_jets=False, counts=None,
+                      top_k=(), image=None, knn=None, relative=False):
+    '''compute the jet based datasets for one chunk of entries, one row per event with its leading
+    jet or, with all_jets, one row per jet. counts, if given, is filled with the number of jets and
+    constituents per row. If the constituent collection is named in top_k, every jet keeps its maxN
+    highest pT constituents. image, a dict of jet_images arguments (npixels, radius), adds the
+    jetImages dataset and knn the <constituents>_knn indices of the knn nearest stored constituents
+    of every stored constituent, aligned with the constituent dataset. relative appends the constituent
+    coordinates relative to the jet axis to the constituent features'''
+    jets, constituents = jet_spec['jets'], jet_spec['constituents']
+    varJets, varPfcands = jet_based_names(jet_spec)
     jet_record = ak.zip({"FatJets": ak.zip({ name : arrays[name] for name in varJets})})#
     pfcand_record = ak.zip({"pfcands": ak.zip({ name : arrays[name] for name in varPfcands})})
-    # save up to 1 fat jet for simplicity
-    nfatjets = 1
+    # save up to jets['maxN'] fat jets, 1 for simplicity
+    nfatjets = jets['maxN']
     #remove empty fat jet arrays 
     #jet_record.FatJets = jet_record.FatJets[jet_record.FatJets.n_fatjet > 0] # or we can do pt>0 , need to check the dataset
     #jet_record.FatJets = jet_record.FatJets[jet_record.FatJets.FatJet_pt > 0] # or we can do pt>0 , need to check the dataset
-    #choose pf candidates associated to this one fat jet
-    fatjetidx = 0
-    pfcand_record.pfcands = pfcand_record.pfcands[pfcand_record.pfcands.PFcand_fjidx == fatjetidx]
+    jet_idx, cand_idx = constituent_pairs(arrays, constituents)
+    fatjet_rows = jet_record.FatJets
+    if all_jets:
+        fatjet_rows, pfcands, origin = explode_jets(jet_record.FatJets, pfcand_record.pfcands, jet_idx, cand_idx)
+        nentries, nfatjets = len(fatjet_rows), 1
+    else:
+        #choose pf candidates associated to this one fat jet
+        fatjetidx = 0
+        pfcands = pfcand_record.pfcands[cand_idx[jet_idx == fatjetidx]]
+    if constituents['name'] in top_k:
+        pfcands = pfcands[pt_order(pfcands[constituents['name']+'_pt'])]
     
     # store objects: jets, and pfcands
-    fatjets,fatjets_names = store_objects_features(jet_record.FatJets, nentries, nobj=nfatjets,obj='FatJet')
-    pfcands,pfcands_names = store_objects_features(pfcand_record.pfcands, nentries, nobj=100,obj='PFcand')
+    fatjets,fatjets_names = store_objects_features(fatjet_rows, nentries, nobj=nfatjets,obj=jets['name'],
+                                                   dtype=jets.get('dtype', dtypes['features']), layout=layout)
+    pfcands_array,pfcands_names = store_objects_features(pfcands, nentries, nobj=constituents['maxN'],obj=constituents['name'],
+                                                         dtype=constituents.get('dtype', dtypes['features']), layout=layout)
+    if relative:
+        # coordinates relative to the jet axis, as additional constituent features
+        relative_array, relative_names = store_objects_relative(pfcands, fatjet_rows, nentries, nobj=constituents['maxN'],
+                                                                obj=constituents['name'], jet=jets['name'],
+                                                                dtype=constituents.get('dtype', dtypes['features']),
+                                                                layout=layout)
+        pfcands_array = np.concatenate([pfcands_array, relative_array], axis=-1)
+        pfcands_names = pfcands_names + relative_names
+    outputs = {jets['output']: fatjets, constituents['output']: pfcands_array}
+    if all_jets:
+        outputs['jetIndex'] = origin
+    if image:
+        outputs['jetImages'] = jet_images(fatjet_rows, pfcands, jets['name'], constituents['name'],
+                                          dtype=dtypes['features'], **image)
+    if layout == 'ragged' or counts is not None or knn:
+        njets = to_counts(fatjet_rows[jets['name']+'_pt'], maxN=nfatjets)
+        ncands = to_counts(pfcands[constituents['name']+'_pt'], maxN=constituents['maxN'])
+    if knn:
+        edges = knn_edges(to_np_array(pfcands[constituents['name']+'_eta'], constituents['maxN']),
+                          to_np_array(pfcands[constituents['name']+'_phi'], constituents['maxN']), ncands, knn)
+        if layout == 'ragged':
+            # one row per stored constituent, sharing the offsets of the constituent dataset
+            edges = edges[np.arange(constituents['maxN']) < ncands[:,None]]
+        outputs[constituents['output']+'_knn'] = edges
+    if layout == 'ragged':
+        outputs[jets['output']+'_offsets'] = njets
+        outputs[constituents['output']+'_offsets'] = ncands
+    if counts is not None:
+        counts[jets['output']], counts[constituents['output']] = njets, ncands
+    return outputs, fatjets_names, pfcands_names
 
-    
-    with h5py.File(output_file, 'w') as outFile:
-        outFile.create_dataset('jetFeatureNames', data=fatjets_names, compression='gzip')
-        outFile.create_dataset('particleFeatureNames', data=pfcands_names, compression='gzip')
-        outFile.create_dataset('fatjets', data=fatjets, compression='gzip')
-        outFile.create_dataset('jetConstituentList', data=pfcands, compression='gzip')
+def plan_jet_based(l1Tree, output_file, entry_start=None, entry_stop=None, precision='single', layout='padded',
+                   spec_file=DEFAULT_SPEC, all_jets=False, cut=None, append=False, stats=False, maxn_quantile=None,
+                   max_objects=None, top_k=(), image_pixels=None, image_radius=0.8, knn=None, relative=False,
+                   scanned=None):
+    '''jet based conversion into one output, see run_conversions. With image_pixels, every row also gets
+    an image_pixels x image_pixels jet image of half-width image_radius, with knn the indices of the
+    knn nearest neighbours of every constituent and with relative the constituent coordinates relative
+    to the jet axis. scanned holds the jet index or association branch and the jet counter if
+    convert_multi already read them for maxn_quantile'''
+    dtypes = PRECISIONS[precision]
+    jet_spec = load_spec(spec_file)['jet']
+
+    # variables to retrieve
+    varJets, varPfcands = jet_based_names(jet_spec)
+    aliases = jet_based_aliases(jet_spec)
+    check_branches(l1Tree, sorted(set(aliases.values())), spec_file)
+
+    # constituents kept per jet, from the jet index or association branch alone with maxn_quantile
+    truncation = None
+    if append and max_objects is None:
+        max_objects = recorded_max_objects(output_file)
+    if max_objects is None and maxn_quantile is not None:
+        with profiled('scan multiplicities'):
+            multiplicities = jet_multiplicities(l1Tree, jet_spec, all_jets, entry_start, entry_stop, cut, scanned)
+        max_objects, truncation = adapt_max_objects(multiplicities, maxn_quantile)
+    jet_spec = dict(jet_spec, constituents=with_max_objects([jet_spec['constituents']], max_objects)[0])
+    collections = [jet_spec['jets'], jet_spec['constituents']]
+    if knn and jet_spec['constituents']['maxN'] > np.iinfo('i2').max:
+        raise ValueError('kNN indices are int16, {} constituents per jet do not fit'.format(
+            jet_spec['constituents']['maxN']))
+
+    out_bytes_per_entry = np.dtype(dtypes['features']).itemsize*(
+        jet_spec['jets']['maxN']*(len(varJets)+3) + jet_spec['constituents']['maxN']*(len(varPfcands)+3+5*relative)
+        + (image_pixels or 0)**2 + jet_spec['constituents']['maxN']*(knn or 0)//2)
+    image = {'npixels': image_pixels, 'radius': image_radius} if image_pixels else None
+    if all_jets and 'counter' in jet_spec['jets']:
+        # one output row per jet, the counter branch is cheap to read if not scanned already
+        if scanned:
+            njets = ak.to_numpy(scanned[jet_spec['jets']['counter']])
+        else:
+            njets = l1Tree[jet_spec['jets']['counter']].array(library='np', entry_start=entry_start,
+                                                              entry_stop=entry_stop)
+        out_bytes_per_entry *= max(1., njets.mean()) if len(njets) else 1.
+
+    def start(outFile):
+        outFile.attrs['layout'] = layout
+        outFile.attrs['maxN'] = json.dumps({c['name']: c['maxN'] for c in collections})
+        if top_k:
+            outFile.attrs['top_k'] = json.dumps(sorted(top_k))
+        if truncation:
+            outFile.attrs['truncation'] = json.dumps(truncation)
+        if cut:
+            outFile.attrs['cut'] = cut
+        # pt columns of the jet and constituent features tell real objects from padding
+        jets, constituents = jet_spec['jets'], jet_spec['constituents']
+        jet_pt = [jets['output'], varJets.index(jets['name']+'_pt')]
+        constituent_pt = [constituents['output'], varPfcands.index(constituents['name']+'_pt')]
+        outFile.attrs['padding_reference'] = json.dumps({jets['output']: jet_pt, constituents['output']: constituent_pt,
+                                                         constituents['output']+'_knn': constituent_pt})
+        if knn:
+            outFile.attrs['knn'] = knn
+        if image:
+            outFile.attrs['jet_image'] = json.dumps(dict(image, axes=['channel', 'eta', 'phi'], weight='pt'))
+
+    accumulated = {}
+    def compute(entries, arrays):
+        counts = {} if stats else None
+        with profiled('compute jet'):
+            outputs, fatjets_names, pfcands_names = jet_based_outputs(arrays, len(entries), jet_spec, dtypes,
+                                                                      layout, all_jets, counts, top_k, image, knn,
+                                                                      relative)
+        if all_jets:
+            outputs['jetIndex'][:,0] = entries[outputs['jetIndex'][:,0]]
+        if stats:
+            with profiled('stats'):
+                update_stats(accumulated, outputs, counts)
+        return outputs, fatjets_names, pfcands_names
 
+    def write(outFile, computed, storage):
+        outputs, fatjets_names, pfcands_names = computed
+        if 'jetFeatureNames' not in outFile:
+            outFile.create_dataset('jetFeatureNames', data=fatjets_names, compression='gzip')
+            outFile.create_dataset('particleFeatureNames', data=pfcands_names, compression='gzip')
+        write_chunk(outFile, outputs, storage)
+
+    def finish(outFile):
+        if stats:
+            write_stats(outFile, accumulated, append)
+
+    return {'aliases': aliases, 'out_bytes_per_entry': out_bytes_per_entry, 'start': start, 'compute': compute,
+            'write': write, 'finish': finish}
+
+def convert_jet_based(input_file, output_file, tree_name, step_size=None, max_memory=None,
+                      entry_start=None, entry_stop=None, precision='single', layout='padded',
+                      spec_file=DEFAULT_SPEC, all_jets=False, compression='gzip', compression_level=None,
+                      chunk_events=None, cut=None, output_format='h5', append=False, pipeline_depth=0, stats=False,
+                      maxn_quantile=None, max_objects=None, top_k=(), file_source=None,
+                      decompression_threads=None, interpretation_threads=None, image_pixels=None, image_radius=0.8,
+                      knn=None, relative=False):
+    convert_multi(input_file, [('jet', output_file, {'all_jets': all_jets, 'image_pixels': image_pixels,
+                                                     'image_radius': image_radius, 'knn': knn,
+                                                     'relative': relative})], tree_name, step_size=step_size,
+                  max_memory=max_memory, entry_start=entry_start, entry_stop=entry_stop, compression=compression,
+                  compression_level=compression_level, chunk_events=chunk_events, cut=cut, output_format=output_format,
+                  append=append, pipeline_depth=pipeline_depth, file_source=file_source,
+                  decompression_threads=decompression_threads, interpretation_threads=interpretation_threads,
+                  precision=precision, layout=layout, spec_file=spec_file, stats=stats, maxn_quantile=maxn_quantile,
+                  max_objects=max_objects, top_k=top_k)
+
+def run_conversions(l1Tree, tasks, output_files, step_size=None, max_memory=None, entry_start=None, entry_stop=None,
+                    cut=None, storage=None, output_format='h5', append=False, pipeline_depth=0):
+    '''run the conversions planned by plan_* functions, reading the union of their branches once per chunk
+    and handing every chunk to all of them. Task i writes output_files[i]'''
+    branches = sorted(set(branch for task in tasks for branch in task['aliases'].values()))
+    step_size = choose_step_size(l1Tree, branches, sum(task['out_bytes_per_entry'] for task in tasks), max_memory,
+                                 step_size, pipeline_depth)
+    with contextlib.ExitStack() as stack:
+        outFiles = [stack.enter_context(open_output(output_file, output_format, append))
+                    for output_file in output_files]
+        for task, outFile in zip(tasks, outFiles):
+            task['start'](outFile)
+
+        def compute(chunk):
+            entries, arrays = chunk
+            return [task['compute'](entries, {name: arrays[branch] for name, branch in task['aliases'].items()})
+                    for task in tasks]
+
+        def write(computed):
+            for task, outFile, outputs in zip(tasks, outFiles, computed):
+                task['write'](outFile, outputs, storage)
+
+        # get awkward arrays chunk by chunk, each branch read once whatever the number of outputs
+        run_pipeline(profiled_iter('read', iterate_logical(l1Tree, {branch: branch for branch in branches}, step_size,
+                                                           entry_start, entry_stop, cut)),
+                     compute, write, pipeline_depth)
+        for task, outFile in zip(tasks, outFiles):
+            task['finish'](outFile)
+
+def convert_multi(input_file, outputs, tree_name, step_size=None, max_memory=None, entry_start=None,
+                  entry_stop=None, compression='gzip', compression_level=None, chunk_events=None, cut=None,
+                  output_format='h5', append=False, pipeline_depth=0, file_source=None, decompression_threads=None,
+                  interpretation_threads=None, **options):
+    '''convert one input into several outputs in a single read pass. outputs is a list of (outtype,
+    output_file) or (outtype, output_file, options) specs, the options of each spec override the
+    common ones (precision, layout, spec_file, stats, maxn_quantile, max_objects, top_k, all_jets)'''
+    storage = storage_options(compression, compression_level, chunk_events)
+    with profiled('open'):
+        inFile = open_input(input_file, file_source, decompression_threads, interpretation_threads)
+    # the file and its thread pools are released whether the conversion succeeds or not
+    try:
+        l1Tree = inFile[tree_name]
+        specs = [(output[0], output[1], dict(options, **(output[2] if len(output) > 2 else {}))) for output in outputs]
+        # the multiplicity pre-scans of all outputs choosing maxN from a quantile read their branches together
+        scan = set()
+        for outtype, output_file, task_options in specs:
+            if (task_options.get('maxn_quantile') is not None and task_options.get('max_objects') is None
+                    and not (append and recorded_max_objects(output_file))):
+                spec_file = task_options.get('spec_file', DEFAULT_SPEC)
+                branches = MULTIPLICITY_BRANCHES[outtype](load_spec(spec_file)[outtype])
+                check_branches(l1Tree, branches, spec_file)
+                scan.update(branches)
+        scanned = None
+        if scan:
+            with profiled('scan multiplicities'):
+                scanned = scan_branches(l1Tree, sorted(scan), entry_start, entry_stop, cut)
+        tasks = [PLANS[outtype](l1Tree, output_file, entry_start=entry_start, entry_stop=entry_stop, cut=cut,
+                                append=append, scanned=scanned, **task_options)
+                 for outtype, output_file, task_options in specs]
+        run_conversions(l1Tree, tasks, [output[1] for output in outputs], step_size, max_memory, entry_start,
+                        entry_stop, cut, storage, output_format, append, pipeline_depth)
+    finally:
+        close_input(inFile)
+
+PLANS = {'event': plan_event_based, 'jet': plan_jet_based}
+
+
+CONVERTERS = {'event': convert_event_based, 'jet': convert_jet_based}
+
+def expand_inputs(patterns):
+    '''expand globs and @filelist arguments into a list of input files'''
+    input_files = []
+    for pattern in patterns:
+        if pattern.startswith('@'):
+            with open(pattern[1:]) as fileList:
+                input_files += [l.strip() for l in fileList if l.strip() and not l.startswith('#')]
+        else:
+            input_files += sorted(glob.glob(pattern)) or [pattern]
+    return input_files
+
+# without --entries-per-shard, the inputs are split into this many shards per worker so that large
+# files keep every worker busy, but not into shards of fewer entries than MIN_ENTRIES_PER_SHARD
+SHARDS_PER_WORKER = 4
+MIN_ENTRIES_PER_SHARD = 1000
+
+def make_shards(input_files, tree_name, entries_per_shard=None, branches=(), spec_file=None, workers=None):
+    '''split the input files into (file, entry_start, entry_stop) shards, checking the required branches.
+    Without entries_per_shard, the shards hold about SHARDS_PER_WORKER shards per worker of the entries'''
+    entries = []
+    for input_file in input_files:
+        with uproot.open(input_file) as inFile:
+            check_branches(inFile[tree_name], branches, spec_file)
+            entries.append(inFile[tree_name].num_entries)
+    if entries_per_shard is None:
+        nshards = SHARDS_PER_WORKER*(workers or os.cpu_count() or 1)
+        entries_per_shard = max(MIN_ENTRIES_PER_SHARD, -(-sum(entries)//nshards))
+    shards = []
+    for input_file, nentries in zip(input_files, entries):
+        step = max(1, entries_per_shard)
+        for start in range(0, nentries, step):
+            shards.append((input_file, start, min(start+step, nentries)))
+    return shards
+
+def convert_shard(outtype, input_file, shard_file, tree_name, entry_start, entry_stop, options, profile=False):
+    '''convert one entry range of one input file, run in a worker process. Returns the shard file and,
+    if profiling, the profile of the worker'''
+    global PROFILE
+    PROFILE = Profile() if profile else None
+    CONVERTERS[outtype](input_file, shard_file, tree_name, entry_start=entry_start, entry_stop=entry_stop, **options)
+    return shard_file, PROFILE.to_dict() if profile else None
+
+def stitch_shards(shard_files, output_file, merge=False, storage=None, output_format='h5', attrs=None):
+    '''combine shard outputs into one file, with virtual datasets or by copying the data'''
+    merge = merge or output_format != 'h5'
+    shapes, dtypes, static, stats = {}, {}, {}, {}
+    extra_attrs, attrs = attrs or {}, {}
+    for shard_file in shard_files:
+        with h5py.File(shard_file, 'r') as shard:
+            attrs.update(shard.attrs)
+            for name, shard_stats in read_stats(shard).items():
+                if name in stats:
+                    stats[name].merge(shard_stats)
+                else:
+                    stats[name] = shard_stats
+            for name, dataset in shard.items():
+                if not isinstance(dataset, h5py.Dataset):
+                    continue
+                if dataset.maxshape[0] is not None:
+                    static.setdefault(name, dataset[()])
+                    continue
+                shapes.setdefault(name, []).append((shard_file, dataset.shape))
+                dtypes[name] = dataset.dtype
+    outdir = os.path.dirname(os.path.abspath(output_file))
+    with open_output(output_file, output_format) as outFile:
+        outFile.attrs.update(attrs)
+        outFile.attrs.update(extra_attrs)
+        for name, data in static.items():
+            outFile.create_dataset(name, data=data, compression='gzip')
+        for name, sources in shapes.items():
+            if name.endswith('_offsets'):
+                # offsets are local to each shard, shift them instead of referencing them
+                for shard_file, _ in sources:
+                    with h5py.File(shard_file, 'r') as shard:
+                        write_chunk(outFile, {name: np.diff(shard[name][()])}, storage)
+                continue
+            if merge:
+                with h5py.File(sources[0][0], 'r') as shard:
+                    chunk_rows = shard[name].chunks[0] if shard[name].chunks else None
+                create_extendable(outFile, name, sources[0][1][1:], dtypes[name], storage, chunk_rows)
+                for shard_file, _ in sources:
+                    with h5py.File(shard_file, 'r') as shard:
+                        append_to_dataset(outFile[name], shard[name][()])
+                continue
+            nrows = sum(shape[0] for _, shape in sources)
+            layout = h5py.VirtualLayout(shape=(nrows,)+sources[0][1][1:], dtype=dtypes[name])
+            offset = 0
+            for shard_file, shape in sources:
+                # relative paths are resolved from the directory of the virtual file
+                relpath = os.path.relpath(os.path.abspath(shard_file), outdir)
+                layout[offset:offset+shape[0]] = h5py.VirtualSource(relpath, name, shape=shape)
+                offset += shape[0]
+            outFile.create_virtual_dataset(name, layout, fillvalue=0)
+        write_stats(outFile, stats)
+    if merge:
+        for shard_file in shard_files:
+            os.remove(shard_file)
+
+def convert_parallel(outtype, input_files, output_file, tree_name, workers=None, entries_per_shard=None,
+                     merge=False, **options):
+    '''convert shards of many input files in a process pool and stitch them into output_file'''
+    spec_file = options.get('spec_file', DEFAULT_SPEC)
+    spec = load_spec(spec_file)[outtype]
+    aliases = event_based_aliases(spec) if outtype == 'event' else jet_based_aliases(spec)
+    branches = set(aliases.values())
+    shards = make_shards(input_files, tree_name, entries_per_shard, branches, spec_file, workers)
+    attrs = {}
+    if options.get('maxn_quantile') is not None and options.get('max_objects') is None:
+        # every shard must pad to the same maxN, chosen from the multiplicities of all inputs
+        multiplicities = {}
+        for input_file in profiled_iter('scan multiplicities', input_files):
+            with uproot.open(input_file) as inFile:
+                tree = inFile[tree_name]
+                if outtype == 'event':
+                    counts = event_multiplicities(tree, spec, cut=options.get('cut'))
+                else:
+                    counts = jet_multiplicities(tree, spec, options.get('all_jets', False), cut=options.get('cut'))
+            for name, n in counts.items():
+                multiplicities.setdefault(name, []).append(n)
+        max_objects, truncation = adapt_max_objects({name: np.concatenate(n) for name, n in multiplicities.items()},
+                                                    options['maxn_quantile'])
+        options = dict(options, max_objects=max_objects, maxn_quantile=None)
+        attrs['truncation'] = json.dumps(truncation)
+    shard_dir = output_file+'_shards'
+    if not os.path.isdir(shard_dir):
+        os.makedirs(shard_dir)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        # shards are always HDF5, other output formats are filled when merging them
+        shard_options = dict(options, output_format='h5')
+        futures = [executor.submit(convert_shard, outtype, input_file,
+                                   os.path.join(shard_dir, 'shard_{:05d}.h5'.format(ishard)),
+                                   tree_name, entry_start, entry_stop, shard_options, PROFILE is not None)
+                   for ishard, (input_file, entry_start, entry_stop) in enumerate(shards)]
+        shard_files = []
+        for future in futures:
+            shard_file, profile = future.result()
+            shard_files.append(shard_file)
+            if profile:
+                PROFILE.merge(profile)
+    with profiled('stitch'):
+        stitch_shards(shard_files, output_file, merge,
+                      storage_options(options.get('compression', 'gzip'), options.get('compression_level'),
+                                      options.get('chunk_events')), options.get('output_format', 'h5'), attrs)
+    if merge or options.get('output_format', 'h5') != 'h5':
+        os.rmdir(shard_dir)
+
+def read_rows(inFile, names, start, stop):
+    '''rows [start, stop) of chunked datasets as a write_chunk dict, ragged datasets with the counts of
+    their offsets dataset'''
+    outputs = {}
+    for name in names:
+        counts = offsets_name(name, inFile)
+        if name.endswith('_offsets'):
+            # read with the values they index
+            continue
+        if counts:
+            offsets = inFile[counts][start:stop+1]
+            outputs[name] = inFile[name][offsets[0]:offsets[-1]]
+            outputs[counts] = np.diff(offsets)
+        else:
+            outputs[name] = inFile[name][start:stop]
+    return outputs
+
+def take_rows(outputs, rows):
+    '''select rows of a write_chunk dict, gathering the values of ragged datasets through their counts'''
+    selected = {}
+    for name, data in outputs.items():
+        counts = offsets_name(name, outputs)
+        if name.endswith('_offsets') or not counts:
+            selected[name] = data[rows]
+            continue
+        n = outputs[counts]
+        starts = (np.cumsum(n)-n)[rows]
+        lengths = n[rows]
+        selected[name] = data[np.repeat(starts-(np.cumsum(lengths)-lengths), lengths)+np.arange(lengths.sum())]
+    return selected
+
+def count_rows(inFile, names):
+    '''number of rows (entries or jets) of the chunked datasets of a converter output'''
+    for name in names:
+        counts = name if name.endswith('_offsets') else offsets_name(name, inFile)
+        if counts:
+            return inFile[counts].shape[0]-1
+    return inFile[names[0]].shape[0] if names else 0
+
+def shard_path(output_file, ishard, output_format='h5'):
+    '''<output>_0000.h5, or an <output>_0000 directory for npy'''
+    root, ext = os.path.splitext(output_file)
+    return '{}_{:04d}{}'.format(root, ishard, ext if output_format == 'h5' else '')
+
+def shuffle_into_shards(input_file, output_file, nshards, seed=0, storage=None, output_format='h5', block_rows=10000):
+    '''split a converter output into nshards files holding its rows in one global random order drawn from
+    seed. Rows are streamed block by block into temporary per-shard files, grouped in buckets of at most
+    block_rows consecutive final positions, then each bucket is permuted and appended to its shard, so
+    memory is bounded by block_rows rows'''
+    with h5py.File(input_file, 'r') as inFile:
+        names = sorted(extendable_datasets(inFile))
+        nrows = count_rows(inFile, names)
+        # final global position of every row, cut into nshards contiguous shards and these into buckets
+        position = np.random.default_rng(seed).permutation(nrows)
+        shard = position*nshards//max(1, nrows)
+        shard_start = -(-np.arange(nshards+1)*nrows//nshards)
+        bucket = (position-shard_start[shard])//block_rows
+        nbuckets = int(-(-np.diff(shard_start).max(initial=0)//block_rows))
+        # input rows of every (shard, bucket), in input order
+        key = shard*nbuckets+bucket
+        by_key = np.argsort(key, kind='stable')
+        key_start = np.searchsorted(key[by_key], np.arange(nshards*nbuckets+1))
+        # a block adds about block_rows/(nshards*nbuckets) rows to every bucket, chunks of that size are
+        # appended without recompressing partly filled chunks
+        temporary_storage = storage_options('lzf', chunk_events=max(1, block_rows//max(1, nshards*nbuckets)))
+        temporary = [h5py.File(shard_path(output_file, i)+'.tmp', 'w') for i in range(nshards)]
+        try:
+            for start in range(0, nrows, block_rows):
+                outputs = read_rows(inFile, names, start, min(start+block_rows, nrows))
+                block_key = key[start:start+block_rows]
+                rows = np.argsort(block_key, kind='stable')
+                keys, first = np.unique(block_key[rows], return_index=True)
+                for k, selected in zip(keys, np.split(rows, first[1:])):
+                    group = temporary[k//nbuckets].require_group(str(k % nbuckets))
+                    write_chunk(group, take_rows(outputs, selected), temporary_storage)
+        finally:
+            for tmpFile in temporary:
+                tmpFile.close()
+        static = {name: d[()] for name, d in inFile.items()
+                  if isinstance(d, h5py.Dataset) and name not in names}
+        attrs, stats = dict(inFile.attrs), read_stats(inFile)
+    shard_files = []
+    for i in range(nshards):
+        shard_files.append(shard_path(output_file, i, output_format))
+        with h5py.File(shard_path(output_file, i)+'.tmp', 'r') as tmpFile, \
+             open_output(shard_files[-1], output_format) as outFile:
+            outFile.attrs.update(attrs)
+            outFile.attrs.update({'shuffle_seed': seed, 'shard': i, 'nshards': nshards})
+            for name, data in static.items():
+                outFile.create_dataset(name, data=data, compression='gzip')
+            for b in range(nbuckets):
+                k = i*nbuckets+b
+                if key_start[k] == key_start[k+1]:
+                    continue
+                # rows were appended in input order, sort them by their global position
+                order = np.argsort(position[by_key[key_start[k]:key_start[k+1]]], kind='stable')
+                write_chunk(outFile, take_rows(read_rows(tmpFile[str(b)], names, 0, len(order)), order), storage)
+            # statistics describe the whole output, every shard carries them
+            write_stats(outFile, dict(stats))
+        os.remove(shard_path(output_file, i)+'.tmp')
+    return shard_files
+
+def load_manifest(manifest_file):
+    '''inputs already converted into an output file, see convert_incremental'''
+    if not os.path.exists(manifest_file):
+        return {'inputs': []}
+    with open(manifest_file) as f:
+        return json.load(f)
+
+def save_manifest(manifest, manifest_file):
+    '''replace the manifest atomically so an interrupted job never leaves it half written'''
+    with open(manifest_file+'.tmp', 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(manifest_file+'.tmp', manifest_file)
+
+def truncate_to_manifest(output_file, manifest):
+    '''drop rows written after the last input recorded in the manifest, e.g. by a job that died mid-file'''
+    rows = manifest['inputs'][-1]['rows'] if manifest['inputs'] else {}
+    with h5py.File(output_file, 'a') as outFile:
+        for name, dataset in extendable_datasets(outFile).items():
+            nrows = rows[name][1] if name in rows else 0
+            if name.endswith('_offsets'):
+                nrows = max(1, nrows)
+            if dataset.shape[0] > nrows:
+                dataset.resize(nrows, axis=0)
+
+def convert_incremental(outtype, input_files, output_file, tree_name, **options):
+    '''convert input files one after the other, appending to output_file. A manifest next to the output
+    records the path, size, mtime and entry range of every converted input and the rows it filled, so
+    re-running skips finished inputs and resumes after the last one'''
+    manifest_file = output_file+'.manifest.json'
+    manifest = load_manifest(manifest_file)
+    if os.path.exists(output_file):
+        truncate_to_manifest(output_file, manifest)
+    done = {entry['path']: entry for entry in manifest['inputs']}
+    for input_file in input_files:
+        path = os.path.abspath(input_file)
+        stat = os.stat(input_file)
+        if path in done:
+            if (done[path]['size'], done[path]['mtime']) != (stat.st_size, stat.st_mtime):
+                raise RuntimeError('{} changed after it was converted into {}'.format(input_file, output_file))
+            continue
+        with uproot.open(input_file) as inFile:
+            nentries = inFile[tree_name].num_entries
+        before = {}
+        if os.path.exists(output_file):
+            with h5py.File(output_file, 'r') as outFile:
+                before = {name: d.shape[0] for name, d in extendable_datasets(outFile).items()}
+        CONVERTERS[outtype](input_file, output_file, tree_name, append=True, **options)
+        with h5py.File(output_file, 'r') as outFile:
+            rows = {name: [before.get(name, 1 if name.endswith('_offsets') else 0), d.shape[0]]
+                    for name, d in extendable_datasets(outFile).items()}
+        manifest['inputs'].append({'path': path, 'size': stat.st_size, 'mtime': stat.st_mtime,
+                                   'entries': [0, nentries], 'rows': rows})
+        save_manifest(manifest, manifest_file)
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
-    parser.add_argument('--outtype', type=str, required=True,help='Use event or jet for event/jet based output')
-    parser.add_argument('--inpfile', type=str, required=True)
-    parser.add_argument('--outfile', type=str, required=True)
+    parser.add_argument('--outtype', type=str, nargs='+', required=True, choices=sorted(CONVERTERS),
+                        help='Use event or jet for event/jet based output, several (e.g. event jet) write one '
+                             '--outfile each from a single read of the input')
+    parser.add_argument('--inpfile', type=str, nargs='+', required=True, help='Input files, globs or @filelist')
+    parser.add_argument('--outfile', type=str, nargs='+', required=True, help='One output per --outtype')
     parser.add_argument('--treename', type=str, default='mmtree/tree')
+    parser.add_argument('--chunk-size', type=int, default=None, help='Number of entries converted at a time')
+    parser.add_argument('--max-memory', type=str, default=None, help='Memory budget used to choose the chunk size, e.g. 2GB')
+    parser.add_argument('--workers', type=int, default=1, help='Number of worker processes')
+    parser.add_argument('--entries-per-shard', type=int, default=None,
+                        help='Split input files into shards of this many entries (default: about {} shards per '
+                             'worker, at least {} entries each)'.format(SHARDS_PER_WORKER, MIN_ENTRIES_PER_SHARD))
+    parser.add_argument('--merge', action='store_true', help='Merge shards into one file instead of a virtual dataset')
+    parser.add_argument('--precision', type=str, default='single', choices=sorted(PRECISIONS),
+                        help='Output dtypes, double reproduces the float64 output of older versions, '
+                             'half rounds all kinematics (also px/py/pz) to 10 mantissa bits')
+    parser.add_argument('--layout', type=str, default='padded', choices=['padded', 'ragged'],
+                        help='Zero-padded arrays, or flat values with int64 *_offsets per collection')
+    parser.add_argument('--spec', type=str, default=DEFAULT_SPEC,
+                        help='JSON/YAML collection spec mapping collections to tree branches, see utils/specs')
+    parser.add_argument('--compression', type=str, default='gzip', choices=['gzip', 'lzf', 'lz4', 'zstd', 'blosc', 'none'],
+                        help='HDF5 compressor, lz4, zstd and blosc need hdf5plugin to write and to read')
+    parser.add_argument('--compression-level', type=int, default=None)
+    parser.add_argument('--chunk-events', type=int, default=None,
+                        help='Entries per HDF5 chunk, align with the training batch size (default: h5py auto-chunking)')
+    parser.add_argument('--cut', type=str, default=None,
+                        help='Entry selection in uproot expression syntax evaluated before the heavy branches are read, '
+                             'e.g. "(scouting_trig == 1) & (nFatJet >= 2)"')
+    parser.add_argument('--format', type=str, default='h5', choices=['h5', 'npy'],
+                        help='HDF5 file, or a directory of uncompressed .npy arrays and a manifest.json for np.memmap')
+    parser.add_argument('--append', action='store_true',
+                        help='Convert inputs one after the other into an existing output, skipping the inputs '
+                             'recorded in <outfile>.manifest.json')
+    parser.add_argument('--pipeline-depth', type=int, default=0,
+                        help='Overlap reading, computing and writing with queues of this many chunks (0: sequential)')
+    parser.add_argument('--stats', action='store_true',
+                        help='Store per-feature count, mean, std, min, max and quantiles of the objects, '
+                             'ignoring the padding, in the group stats/<dataset>')
+    parser.add_argument('--maxn-quantile', type=float, default=None,
+                        help='Pick the maxN of every collection (constituents per jet in jet mode) from this quantile '
+                             'of its multiplicity, e.g. 0.999, scanning only the counter branches first')
+    parser.add_argument('--maxn', type=str, nargs='+', default=None,
+                        help='Override the maxN of collections, e.g. PFcand=128 bPFcand=64')
+    parser.add_argument('--top-k', type=str, nargs='+', default=(),
+                        help='Collections, e.g. PFcand bPFcand, keeping their maxN highest pT objects instead of the '
+                             'first maxN in storage order (constituents of each jet in jet mode)')
+    parser.add_argument('--shuffle-shards', type=int, default=None,
+                        help='Write the output as this many shards <outfile>_0000.h5, ... holding the rows in one '
+                             'global random order drawn from --seed')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the --shuffle-shards order')
+    parser.add_argument('--file-source', type=str, default='default', choices=sorted(FILE_SOURCES),
+                        help='uproot source reading the input files, memmap maps local files into memory')
+    parser.add_argument('--decompression-threads', type=int, default=None,
+                        help='Threads decompressing baskets (default: decompress in the reading thread)')
+    parser.add_argument('--interpretation-threads', type=int, default=None,
+                        help='Threads interpreting decompressed baskets as arrays')
+    parser.add_argument('--profile', nargs='?', const='', default=None, metavar='JSON',
+                        help='Print the wall time, CPU time and peak RSS of every stage (open, read, store_objects_*, '
+                             'write <dataset>, ...) and the bytes read and written, and save them to JSON if given. '
+                             'Stages nest, compute includes the store_objects_* calls')
+    parser.add_argument('--jet-image', type=int, default=None, metavar='NPIXELS',
+                        help='Jet based output: add jetImages, pT-weighted NPIXELS x NPIXELS constituent images '
+                             'in (delta eta, delta phi) around the jet axis, e.g. 40')
+    parser.add_argument('--jet-image-radius', type=float, default=0.8,
+                        help='Half-width of the jet images in eta and phi')
+    parser.add_argument('--knn', type=int, default=None, metavar='K',
+                        help='Jet based output: add <constituents>_knn, int16 indices of the K nearest constituents '
+                             'in (eta, phi) of every stored constituent, -1 for padding, e.g. 16')
+    parser.add_argument('--relative-features', action='store_true',
+                        help='Jet based output: append deta, dphi, logptrel, logerel and deltaR of the constituents '
+                             'relative to the jet axis to particleFeatureNames')
+    parser.add_argument('--event-features', action='store_true',
+                        help='Event based output: add EventFeatures (HT, mjj, deta_jj and with MET in the spec MET, MT, '
+                             'dphi_j1_met, dphi_j2_met, dphi_min_met) named in EventFeatureNames, from the '
+                             'event_features section of the spec')
+    parser.add_argument('--all-jets', action='store_true',
+                        help='Jet based output with one row per fat jet instead of the leading jet of each event')
     args = parser.parse_args()
-    if args.outtype=='event' :  
-        convert_event_based(args.inpfile, args.outfile, args.treename)
-    elif args.outtype=='jet' :
-        convert_jet_based(args.inpfile, args.outfile, args.treename)
-
+    options = dict(step_size=args.chunk_size, max_memory=args.max_memory, precision=args.precision,
+                   layout=args.layout, spec_file=args.spec, compression=args.compression,
+                   compression_level=args.compression_level, chunk_events=args.chunk_events, cut=args.cut,
+                   output_format=args.format, pipeline_depth=args.pipeline_depth, stats=args.stats,
+                   maxn_quantile=args.maxn_quantile, top_k=args.top_k, file_source=args.file_source,
+                   decompression_threads=args.decompression_threads,
+                   interpretation_threads=args.interpretation_threads)
+    if args.maxn:
+        options['max_objects'] = {n.split('=')[0]: int(n.split('=')[1]) for n in args.maxn}
+    # options of a single output type, refused if no --outtype takes them
+    type_options = {outtype: {} for outtype in CONVERTERS}
+    for outtype, flag, values in (
+            ('jet', '--all-jets', args.all_jets and {'all_jets': True}),
+            ('jet', '--jet-image', args.jet_image and {'image_pixels': args.jet_image,
+                                                       'image_radius': args.jet_image_radius}),
+            ('jet', '--knn', args.knn and {'knn': args.knn}),
+            ('jet', '--relative-features', args.relative_features and {'relative': True}),
+            ('event', '--event-features', args.event_features and {'features': True})):
+        if values:
+            if outtype not in args.outtype:
+                parser.error('{} only applies to --outtype {}'.format(flag, outtype))
+            type_options[outtype].update(values)
+    input_files = expand_inputs(args.inpfile)
+    if len(args.outfile) != len(args.outtype):
+        parser.error('give one --outfile per --outtype')
+    multi = len(args.outtype) > 1
+    if multi and (len(input_files) > 1 or args.workers > 1 or args.entries_per_shard or args.append
+                  or args.shuffle_shards):
+        parser.error('several --outtype convert a single input file, without --workers, --entries-per-shard, '
+                     '--append or --shuffle-shards')
+    if not multi:
+        args.outtype, args.outfile = args.outtype[0], args.outfile[0]
+        options.update(type_options[args.outtype])
+    outfile = args.outfile
+    if args.profile is not None:
+        PROFILE = Profile()
+        start, cpu = time.perf_counter(), time.process_time()
+    if args.shuffle_shards:
+        if args.append:
+            parser.error('--shuffle-shards cannot be combined with --append')
+        # convert to an intermediate HDF5 file that is then split into the shuffled shards
+        root, ext = os.path.splitext(args.outfile)
+        outfile = root+'_unshuffled.h5'
+        options['output_format'] = 'h5'
+    if multi:
+        convert_multi(input_files[0], [(outtype, output_file, type_options[outtype])
+                                       for outtype, output_file in zip(args.outtype, args.outfile)],
+                      args.treename, **options)
+    elif args.append:
+        convert_incremental(args.outtype, input_files, outfile, args.treename, **options)
+    elif len(input_files)==1 and args.workers==1 and args.entries_per_shard is None:
+        CONVERTERS[args.outtype](input_files[0], outfile, args.treename, **options)
+    else:
+        convert_parallel(args.outtype, input_files, outfile, args.treename, args.workers,
+                         args.entries_per_shard, args.merge, **options)
+    if args.shuffle_shards:
+        with profiled('shuffle'):
+            shuffle_into_shards(outfile, args.outfile, args.shuffle_shards, args.seed,
+                                storage_options(args.compression, args.compression_level, args.chunk_events),
+                                args.format, args.chunk_size or 10000)
+        os.remove(outfile)
+        if os.path.isdir(outfile+'_shards'):
+            # shards of a virtual dataset
+            shutil.rmtree(outfile+'_shards')
+    if PROFILE is not None:
+        PROFILE.add('total', {'calls': 1, 'wall_s': time.perf_counter()-start, 'cpu_s': time.process_time()-cpu,
+                              'peak_rss_MB': peak_rss()/1024**2, 'peak_rss_growth_MB': 0.})
+        outputs = ([shard_path(args.outfile, i, args.format) for i in range(args.shuffle_shards)]
+                   if args.shuffle_shards else args.outfile if multi else [args.outfile, args.outfile+'_shards'])
+        output_bytes = sum(output_size(path) for path in outputs if os.path.exists(path))
+        PROFILE.report(output_bytes)
+        if args.profile:
+            with open(args.profile, 'w') as f:
+                json.dump(dict(PROFILE.to_dict(), output_bytes=output_bytes), f, indent=2)
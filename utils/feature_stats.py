@@ -0,0 +1,134 @@
+from __future__ import print_function, division
+import numpy as np
+
+# quantile levels stored with the normalization statistics
+STATS_QUANTILES = (0.001, 0.01, 0.05, 0.25, 0.5, 0.75, 0.95, 0.99, 0.999)
+
+def compress_digest(means, weights, delta=200):
+    '''merge weighted centroids into at most about delta/2 t-digest centroids, using the arcsine scale
+    function so that centroids near the tails stay small and extreme quantiles stay accurate'''
+    keep = weights > 0
+    order = np.argsort(means[keep], kind='stable')
+    means, weights = means[keep][order], weights[keep][order]
+    if not len(means):
+        return means, weights
+    left = (np.cumsum(weights)-weights)/weights.sum()
+    k = np.floor(delta/(2*np.pi)*np.arcsin(2*left-1))
+    group = np.concatenate([[0], np.cumsum(np.diff(k) > 0)])
+    merged_weights = np.bincount(group, weights)
+    return np.bincount(group, weights*means)/merged_weights, merged_weights
+
+def digest_of_sorted(values, delta=200):
+    '''t-digest centroids of sorted unit-weight values, the cluster boundaries of the arcsine scale
+    function are known in advance so the centroids are block means'''
+    if not len(values):
+        return np.zeros(0), np.zeros(0)
+    k = np.arange(-(delta//4), delta//4+1)
+    starts = np.unique(np.clip(np.ceil((np.sin(2*np.pi*k/delta)+1)/2*len(values)), 0, len(values)-1).astype('i8'))
+    weights = np.diff(np.append(starts, len(values))).astype('f8')
+    return np.add.reduceat(values, starts)/weights, weights
+
+class FeatureStats(object):
+    '''mergeable per-feature count, mean, variance, min, max and t-digest quantiles of the rows of a dataset.
+    Chunks are combined with the parallel form of Welford's algorithm, so statistics accumulated per chunk
+    or per shard merge to those of the whole output'''
+    fields = ('count', 'mean', 'm2', 'min', 'max', 'centroid_mean', 'centroid_weight')
+
+    def __init__(self, nfeatures, delta=200):
+        self.delta, self.count = delta, 0
+        self.mean, self.m2 = np.zeros(nfeatures), np.zeros(nfeatures)
+        self.min, self.max = np.full(nfeatures, np.inf), np.full(nfeatures, -np.inf)
+        self.digests = [(np.zeros(0), np.zeros(0)) for _ in range(nfeatures)]
+
+    @classmethod
+    def from_values(cls, values, delta=200):
+        '''statistics of a (nrows, nfeatures) array'''
+        values = np.asarray(values, dtype='f8')
+        stats = cls(values.shape[1], delta)
+        if len(values):
+            stats.count = len(values)
+            stats.mean = values.mean(axis=0)
+            stats.m2 = ((values-stats.mean)**2).sum(axis=0)
+            stats.min, stats.max = values.min(axis=0), values.max(axis=0)
+            stats.digests = [digest_of_sorted(column, delta) for column in np.sort(values, axis=0).T]
+        return stats
+
+    def update(self, values):
+        self.merge(FeatureStats.from_values(values, self.delta))
+
+    def merge(self, other):
+        if not other.count:
+            return
+        count = self.count+other.count
+        diff = other.mean-self.mean
+        self.mean = self.mean+diff*other.count/count
+        self.m2 = self.m2+other.m2+diff**2*self.count*other.count/count
+        self.count = count
+        self.min, self.max = np.minimum(self.min, other.min), np.maximum(self.max, other.max)
+        self.digests = [compress_digest(np.concatenate([m, om]), np.concatenate([w, ow]), self.delta)
+                        for (m, w), (om, ow) in zip(self.digests, other.digests)]
+
+    def std(self):
+        return np.sqrt(self.m2/max(1, self.count))
+
+    def quantiles(self, levels=STATS_QUANTILES):
+        '''(len(levels), nfeatures) quantiles interpolated between centroids and the exact extremes'''
+        result = np.zeros((len(levels), len(self.digests)))
+        for i, (means, weights) in enumerate(self.digests):
+            if len(means):
+                mids = np.cumsum(weights)-weights/2
+                result[:,i] = np.interp(np.asarray(levels)*self.count, np.concatenate([[0], mids, [self.count]]),
+                                        np.concatenate([[self.min[i]], means, [self.max[i]]]))
+        return result
+
+    def write(self, outFile, name):
+        '''store as datasets of the group stats/<name>, replacing earlier statistics'''
+        ncentroids = max([len(m) for m, _ in self.digests]+[1])
+        centroid_mean = np.zeros((len(self.digests), ncentroids))
+        centroid_weight = np.zeros((len(self.digests), ncentroids))
+        for i, (means, weights) in enumerate(self.digests):
+            centroid_mean[i,:len(means)], centroid_weight[i,:len(weights)] = means, weights
+        data = {'count': np.full(len(self.mean), self.count, dtype='i8'), 'mean': self.mean, 'std': self.std(), 'm2': self.m2,
+                'min': self.min, 'max': self.max, 'quantile_levels': np.asarray(STATS_QUANTILES),
+                'quantiles': self.quantiles(), 'centroid_mean': centroid_mean, 'centroid_weight': centroid_weight}
+        for field, values in data.items():
+            path = 'stats/{}/{}'.format(name, field)
+            if path in outFile:
+                del outFile[path]
+            outFile.create_dataset(path, data=values)
+
+    @classmethod
+    def read(cls, outFile, name, delta=200):
+        '''statistics stored by write'''
+        data = {field: outFile['stats/{}/{}'.format(name, field)][()] for field in cls.fields}
+        stats = cls(len(data['mean']), delta)
+        stats.count, stats.mean, stats.m2 = int(data['count'].max(initial=0)), data['mean'], data['m2']
+        stats.min, stats.max = data['min'], data['max']
+        stats.digests = [(m[w > 0], w[w > 0]) for m, w in zip(data['centroid_mean'], data['centroid_weight'])]
+        return stats
+
+def update_stats(stats, outputs, counts):
+    '''accumulate the statistics of every dataset in counts over its objects, ignoring the padding'''
+    for name, n in counts.items():
+        data = outputs[name]
+        if data.ndim == 3:
+            data = data[np.arange(data.shape[1]) < n[:,None]]
+        if name not in stats:
+            stats[name] = FeatureStats(data.shape[-1])
+        stats[name].update(data)
+
+def read_stats(outFile):
+    '''dataset name -> FeatureStats stored in an HDF5 output'''
+    if 'stats' not in outFile:
+        return {}
+    return {name: FeatureStats.read(outFile, name) for name in outFile['stats']}
+
+def write_stats(outFile, stats, append=False):
+    '''store the statistics of a conversion, merged into those already in the file when appending'''
+    if append:
+        for name, previous in read_stats(outFile).items():
+            if name in stats:
+                previous.merge(stats[name])
+            stats[name] = previous
+    for name, accumulated in stats.items():
+        accumulated.write(outFile, name)
@@ -0,0 +1,91 @@
+from __future__ import print_function, division
+import os
+import json
+import struct
+import numpy as np
+
+class NpyDataset(object):
+    '''append-only .npy file with a fixed size header that is rewritten with the final shape on close'''
+    header_size = 128
+
+    def __init__(self, path, shape, dtype):
+        self.path, self.shape, self.dtype = path, (0,)+tuple(shape), np.dtype(dtype)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        self._file = open(path, 'wb')
+        self._write_header()
+
+    def _write_header(self):
+        header = "{{'descr': {!r}, 'fortran_order': False, 'shape': {!r}, }}".format(
+            np.lib.format.dtype_to_descr(self.dtype), tuple(self.shape))
+        header = header.ljust(self.header_size-11)+'\n'
+        self._file.seek(0)
+        self._file.write(b'\x93NUMPY\x01\x00'+struct.pack('<H', len(header))+header.encode('latin1'))
+        self._file.seek(0, 2)
+
+    def resize(self, nrows, axis=0):
+        self.shape = (nrows,)+self.shape[1:]
+
+    def __setitem__(self, key, data):
+        self._file.write(np.ascontiguousarray(data, dtype=self.dtype).tobytes())
+
+    def __getitem__(self, key):
+        self._file.flush()
+        return np.memmap(self.path, dtype=self.dtype, mode='r', offset=self.header_size, shape=self.shape)[key]
+
+    def close(self):
+        self._write_header()
+        self._file.close()
+
+class NpyDirectory(object):
+    '''directory of uncompressed, memory-mappable .npy arrays with a manifest.json, written through
+    the part of the h5py.File interface the converter uses'''
+
+    def __init__(self, path):
+        self.path, self.attrs, self.datasets = path, {}, {}
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def __contains__(self, name):
+        return name in self.datasets
+
+    def __getitem__(self, name):
+        return self.datasets[name]
+
+    def create_dataset(self, name, shape=None, dtype=None, data=None, **kwargs):
+        if data is not None:
+            data = np.asarray(data)
+            if data.dtype.kind == 'O':
+                # variable length strings read back from HDF5
+                data = data.astype('S')
+            self.datasets[name] = NpyDataset(os.path.join(self.path, name+'.npy'), data.shape[1:], data.dtype)
+            self.datasets[name].resize(len(data))
+            self.datasets[name][:] = data
+        else:
+            self.datasets[name] = NpyDataset(os.path.join(self.path, name+'.npy'), shape[1:], dtype)
+        # filled chunk by chunk, like resizable HDF5 datasets
+        self.datasets[name].extendable = kwargs.get('maxshape') is not None
+        return self.datasets[name]
+
+    def close(self):
+        manifest = {'format': 'npy', 'attrs': self.attrs, 'datasets': {}}
+        for name, dataset in self.datasets.items():
+            dataset.close()
+            manifest['datasets'][name] = {'file': name+'.npy', 'shape': list(dataset.shape), 'dtype': dataset.dtype.str,
+                                          'extendable': dataset.extendable}
+        with open(os.path.join(self.path, 'manifest.json'), 'w') as f:
+            json.dump(manifest, f, indent=2, default=lambda o: o.tolist())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def load_npy_directory(path, mmap_mode='r'):
+    '''memory-map every array of an npy output directory, returns (name -> array, attrs)'''
+    with open(os.path.join(path, 'manifest.json')) as f:
+        manifest = json.load(f)
+    arrays = {name: np.load(os.path.join(path, d['file']), mmap_mode=mmap_mode)
+              for name, d in manifest['datasets'].items()}
+    return arrays, manifest['attrs']
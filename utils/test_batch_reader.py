@@ -0,0 +1,82 @@
+from __future__ import print_function, division
+import numpy as np
+import h5py
+import pytest
+from convert_to_h5 import DEFAULT_SPEC, convert_event_based, convert_jet_based, load_spec
+from batch_reader import iterate_batches, padding_references
+
+TREE = 'mmtree/tree'
+
+def convert_events(ntuple, tmp_path, layout='padded', output_format='h5'):
+    '''event based conversion of the ntuple fixture, returning its path'''
+    path, spec_file = ntuple
+    output = str(tmp_path/'events_{}.{}'.format(layout, output_format))
+    convert_event_based(path, output, TREE, spec_file=spec_file, layout=layout, output_format=output_format)
+    return output
+
+def read_all(path, **options):
+    '''every batch of iterate_batches, in order'''
+    return list(iterate_batches(path, **options))
+
+@pytest.mark.parametrize('layout', ['padded', 'ragged'])
+@pytest.mark.parametrize('shuffle_buffer', [0, 50])
+def test_batches_cover_rows(ntuple, tmp_path, layout, shuffle_buffer):
+    '''padded and ragged->padded batches, with or without a shuffle pool, give back every row exactly once'''
+    reference = convert_events(ntuple, tmp_path)
+    output = reference if layout == 'padded' else convert_events(ntuple, tmp_path, layout)
+    names = ['FatJet_cyl', 'Jet_cyl']
+    maxN = {c['output']+'_cyl': c['maxN'] for c in load_spec(ntuple[1])['event']}
+    with h5py.File(reference, 'r') as inFile:
+        expected = [tuple(rows) for rows in zip(*[[row.tobytes() for row in inFile[name][()]] for name in names])]
+    rows, sizes = [], []
+    for batch in read_all(output, batch_size=16, datasets=names, shuffle_buffer=shuffle_buffer, seed=5, maxN=maxN):
+        assert sorted(batch) == names
+        sizes.append(len(batch[names[0]]))
+        rows += zip(*[[row.tobytes() for row in batch[name]] for name in names])
+    assert sizes[:-1] == [16]*(len(sizes)-1)
+    assert sorted(rows) == sorted(expected)
+    assert (rows == expected) == (not shuffle_buffer)
+
+@pytest.mark.parametrize('ntuple', [DEFAULT_SPEC], ids=['legacy'], indirect=True)
+def test_truth_mask(ntuple, tmp_path):
+    '''the mask of the truth flags is the non-zero pt of the candidates, also where fromsuep is 0'''
+    output = convert_events(ntuple, tmp_path)
+    assert padding_references(output)['Pfcand_truth'] == ('Pfcand_cyl', 0)
+    batches = read_all(output, batch_size=32, mask=True)
+    for batch in batches:
+        np.testing.assert_array_equal(batch['Pfcand_truth_mask'], batch['Pfcand_cyl'][...,0] != 0)
+    assert any((batch['Pfcand_truth_mask'] & (batch['Pfcand_truth'][...,0] == 0)).any() for batch in batches)
+    # the pt the mask comes from is read along and dropped
+    truth_only = read_all(output, batch_size=32, datasets=['Pfcand_truth'], mask=True)
+    assert all(sorted(batch) == ['Pfcand_truth', 'Pfcand_truth_mask'] for batch in truth_only)
+    np.testing.assert_array_equal(np.concatenate([batch['Pfcand_truth_mask'] for batch in truth_only]),
+                                  np.concatenate([batch['Pfcand_truth_mask'] for batch in batches]))
+
+def test_knn_mask(ntuple, tmp_path):
+    '''the mask of the kNN edges is the non-zero pt of the constituents, not the -1 of missing neighbours,
+    and the same for the padded output and the ragged output padded by the reader'''
+    path, spec_file = ntuple
+    masks = {}
+    for layout in ('padded', 'ragged'):
+        output = str(tmp_path/'jets_{}.h5'.format(layout))
+        convert_jet_based(path, output, TREE, spec_file=spec_file, all_jets=True, knn=4, layout=layout)
+        with h5py.File(output, 'r') as outFile:
+            names = [n.decode() for n in outFile['particleFeatureNames'][()]]
+        pt = names.index(load_spec(spec_file)['jet']['constituents']['name']+'_pt')
+        maxN = load_spec(spec_file)['jet']['constituents']['maxN']
+        batches = read_all(output, batch_size=32, mask=True, maxN=maxN)
+        for batch in batches:
+            np.testing.assert_array_equal(batch['jetConstituentList_knn_mask'], batch['jetConstituentList'][...,pt] != 0)
+        masks[layout] = np.concatenate([batch['jetConstituentList_knn_mask'] for batch in batches])
+    np.testing.assert_array_equal(masks['padded'], masks['ragged'])
+
+@pytest.mark.parametrize('layout', ['padded', 'ragged'])
+def test_npy_matches_h5(ntuple, tmp_path, layout):
+    '''an npy directory reads back the same batches and masks as the HDF5 file'''
+    h5_batches = read_all(convert_events(ntuple, tmp_path, layout), batch_size=32, mask=True, layout=layout)
+    npy_batches = read_all(convert_events(ntuple, tmp_path, layout, 'npy'), batch_size=32, mask=True, layout=layout)
+    assert len(h5_batches) == len(npy_batches)
+    for h5_batch, npy_batch in zip(h5_batches, npy_batches):
+        assert sorted(h5_batch) == sorted(npy_batch)
+        for name, data in h5_batch.items():
+            np.testing.assert_array_equal(npy_batch[name], data)
@@ -0,0 +1,332 @@
+from __future__ import print_function, division
+import os
+import math
+import shutil
+import threading
+import numpy as np
+import awkward as ak
+import uproot
+import h5py
+import pytest
+import convert_to_h5
+from convert_to_h5 import (CONVERTERS, convert_event_based, convert_incremental, convert_jet_based, convert_multi,
+                           convert_shard, count_rows, delta_phi, explode_jets, extendable_datasets, knn_edges,
+                           load_spec, make_shards, read_rows, selected_ranges, shuffle_into_shards, stitch_shards,
+                           take_rows)
+from feature_stats import read_stats
+from bench_convert import make_ntuple
+
+TREE = 'mmtree/tree'
+
+def read_tree(path, branches):
+    '''branch -> list of per-entry numpy arrays or values'''
+    arrays = uproot.open(path)[TREE].arrays(sorted(set(branches)))
+    return {b: [np.asarray(v) for v in ak.to_list(arrays[b])] for b in set(branches)}
+
+def jet_constituents(path, jet_spec):
+    '''tree branches and (entry, jet) -> indices of the constituents of that jet, in association order'''
+    jets, constituents = jet_spec['jets'], jet_spec['constituents']
+    branches = list(jets['branches'].values())+list(constituents['branches'].values())
+    branches += list(constituents.get('association', {}).values())
+    tree = read_tree(path, branches)
+    owned = {}
+    for i, jet_pt in enumerate(tree[jets['branches']['pt']]):
+        if 'association' in constituents:
+            pairs = zip(tree[constituents['association']['jet']][i], tree[constituents['association']['constituent']][i])
+        else:
+            pairs = ((j, c) for c, j in enumerate(tree[constituents['branches'][constituents['jet_index']]][i]))
+        owned.update(((i, j), []) for j in range(len(jet_pt)))
+        for j, c in pairs:
+            if 0 <= j < len(jet_pt):
+                owned[i, int(j)].append(int(c))
+    return tree, owned
+
+def test_explode_jets():
+    '''one row per jet holding the constituents paired with it, pairs out of range are dropped'''
+    rng = np.random.default_rng(1)
+    njet, ncand = rng.poisson(2, 50), rng.poisson(6, 50)
+    npair = rng.poisson(8, 50)
+    jets = ak.unflatten(ak.zip({'pt': rng.uniform(size=njet.sum())}), njet)
+    pfcands = ak.unflatten(ak.zip({'pt': rng.uniform(size=ncand.sum())}), ncand)
+    jet_idx = ak.unflatten(rng.integers(-1, 4, npair.sum()), npair)
+    cand_idx = ak.unflatten(rng.integers(-1, 9, npair.sum()), npair)
+    rows, cands, origin = explode_jets(jets, pfcands, jet_idx, cand_idx)
+    expected_origin, expected_cands = [], []
+    for i in range(len(njet)):
+        for j in range(njet[i]):
+            expected_origin.append([i, j])
+            expected_cands.append([pfcands[i][c]['pt'] for jj, c in zip(jet_idx[i], cand_idx[i])
+                                   if jj == j and 0 <= c < ncand[i]])
+    np.testing.assert_array_equal(origin, np.asarray(expected_origin).reshape(-1, 2))
+    assert ak.to_list(rows['pt']) == [[jets[i][j]['pt']] for i, j in expected_origin]
+    assert ak.to_list(cands['pt']) == expected_cands
+
+def test_selected_ranges(ntuple):
+    '''the ranges cover exactly the baskets holding a selected entry, merged when adjacent'''
+    tree = uproot.open(ntuple[0])[TREE]
+    branches = ['FatJet_pt', 'FatJet_eta']
+    entry_start = 30
+    mask = np.random.default_rng(2).uniform(size=150) < 0.01
+    mask[-1] = True
+    ranges = selected_ranges(tree, branches, mask, entry_start)
+    covered = np.zeros(len(mask), dtype=bool)
+    for start, stop in ranges:
+        covered[start-entry_start:stop-entry_start] = True
+    offsets = np.asarray(tree.common_entry_offsets(filter_name=branches))
+    expected = np.zeros(len(mask), dtype=bool)
+    for start, stop in zip(offsets[:-1], offsets[1:]):
+        basket = slice(max(start, entry_start)-entry_start, max(min(stop, entry_start+len(mask))-entry_start, 0))
+        expected[basket] = mask[basket].any()
+    np.testing.assert_array_equal(covered, expected)
+    assert all(stop < next_start for (_, stop), (next_start, _) in zip(ranges[:-1], ranges[1:]))
+    assert selected_ranges(tree, branches, np.zeros(150, dtype=bool), entry_start) == []
+
+@pytest.mark.parametrize('layout', ['padded', 'ragged'])
+@pytest.mark.parametrize('block_rows', [64, 5])
+def test_shuffle_permutation(ntuple, tmp_path, layout, block_rows):
+    '''the shards hold every row once, in the global order drawn from the seed, also when a shard is
+    permuted in many buckets of block_rows rows'''
+    path, spec_file = ntuple
+    output = str(tmp_path/'events.h5')
+    convert_event_based(path, output, TREE, spec_file=spec_file, layout=layout, stats=True)
+    shard_files = shuffle_into_shards(output, str(tmp_path/'shuffled.h5'), 3, seed=7, block_rows=block_rows)
+    with h5py.File(output, 'r') as inFile:
+        names = sorted(extendable_datasets(inFile))
+        nrows = count_rows(inFile, names)
+        original = read_rows(inFile, names, 0, nrows)
+    shards = []
+    for shard_file in shard_files:
+        with h5py.File(shard_file, 'r') as shardFile:
+            shards.append(read_rows(shardFile, names, 0, count_rows(shardFile, names)))
+            assert 'stats' in shardFile
+    # row k of the concatenated shards is the input row placed at position k
+    expected = take_rows(original, np.argsort(np.random.default_rng(7).permutation(nrows)))
+    assert sorted(expected) == sorted(shards[0])
+    for name, data in expected.items():
+        np.testing.assert_array_equal(np.concatenate([shard[name] for shard in shards]), data)
+
+def test_jet_images(ntuple, tmp_path):
+    '''every image is the pt-weighted histogram2d of all constituents of its jet around the jet axis'''
+    path, spec_file = ntuple
+    jet_spec = load_spec(spec_file)['jet']
+    output = str(tmp_path/'jets.h5')
+    convert_jet_based(path, output, TREE, spec_file=spec_file, precision='double', all_jets=True,
+                      image_pixels=12, image_radius=0.6)
+    with h5py.File(output, 'r') as outFile:
+        images, origin = outFile['jetImages'][()], outFile['jetIndex'][()]
+    tree, owned = jet_constituents(path, jet_spec)
+    jets, constituents = jet_spec['jets']['branches'], jet_spec['constituents']['branches']
+    assert len(images) == len(owned)
+    for image, (i, j) in zip(images, origin):
+        cands = owned[i, j]
+        deta = tree[constituents['eta']][i][cands].astype('f8') - tree[jets['eta']][i][j]
+        dphi = delta_phi(tree[constituents['phi']][i][cands].astype('f8'), float(tree[jets['phi']][i][j]))
+        expected, _, _ = np.histogram2d(deta, dphi, bins=12, range=[[-0.6, 0.6], [-0.6, 0.6]],
+                                        weights=tree[constituents['pt']][i][cands])
+        np.testing.assert_allclose(image[0], expected, rtol=1e-6, atol=1e-9)
+
+def test_knn_edges():
+    '''indices of the nearest real objects, nearest first, as a brute-force argsort finds them'''
+    rng = np.random.default_rng(4)
+    nrows, maxN, k = 60, 25, 6
+    counts = rng.integers(0, maxN+1, nrows)
+    counts[:4] = [0, 1, 2, maxN]
+    real = np.arange(maxN) < counts[:,None]
+    eta = np.where(real, rng.uniform(-1, 1, (nrows, maxN)), 0)
+    phi = np.where(real, rng.uniform(-np.pi, np.pi, (nrows, maxN)), 0)
+    # blocks of a few rows, so that rows with different widths share a block
+    edges = knn_edges(eta, phi, counts, k, block_pairs=7*maxN*maxN)
+    assert edges.dtype == np.int16
+    for row in range(nrows):
+        for obj in range(maxN):
+            expected = np.full(k, -1)
+            if obj < counts[row]:
+                others = np.array([o for o in range(counts[row]) if o != obj], dtype='i8')
+                d2 = (eta[row,others]-eta[row,obj])**2 + delta_phi(phi[row,others], phi[row,obj])**2
+                nearest = others[np.argsort(d2, kind='stable')][:k]
+                expected[:len(nearest)] = nearest
+            np.testing.assert_array_equal(edges[row,obj], expected)
+
+def test_knn_output(ntuple, tmp_path):
+    '''the stored edges index the stored constituents of the row, nearest first, real ones only'''
+    path, spec_file = ntuple
+    jet_spec = load_spec(spec_file)['jet']
+    output = str(tmp_path/'jets.h5')
+    convert_jet_based(path, output, TREE, spec_file=spec_file, precision='double', all_jets=True, knn=4)
+    with h5py.File(output, 'r') as outFile:
+        cands, edges = outFile['jetConstituentList'][()], outFile['jetConstituentList_knn'][()]
+        names = [n.decode() for n in outFile['particleFeatureNames'][()]]
+        origin = outFile['jetIndex'][()]
+    _, owned = jet_constituents(path, jet_spec)
+    name = jet_spec['constituents']['name']
+    eta, phi = cands[...,names.index(name+'_eta')], cands[...,names.index(name+'_phi')]
+    counts = np.array([min(len(owned[i, j]), jet_spec['constituents']['maxN']) for i, j in origin])
+    for row in range(0, len(cands), 7):
+        n = counts[row]
+        d2 = (eta[row,:n,None]-eta[row,None,:n])**2 + delta_phi(phi[row,:n,None], phi[row,None,:n])**2
+        d2[np.diag_indices(n)] = np.inf
+        nearest = np.argsort(d2, axis=1, kind='stable')[:,:min(4, max(n-1, 0))]
+        np.testing.assert_array_equal(edges[row,:n,:nearest.shape[1]], nearest)
+        assert (edges[row,:n,nearest.shape[1]:] == -1).all() and (edges[row,n:] == -1).all()
+
+def test_relative_features(ntuple, tmp_path):
+    '''relative coordinates of the stored constituents computed jet by jet'''
+    path, spec_file = ntuple
+    jet_spec = load_spec(spec_file)['jet']
+    output = str(tmp_path/'jets.h5')
+    convert_jet_based(path, output, TREE, spec_file=spec_file, precision='double', all_jets=True, relative=True)
+    with h5py.File(output, 'r') as outFile:
+        cands, origin = outFile['jetConstituentList'][()], outFile['jetIndex'][()]
+        names = [n.decode() for n in outFile['particleFeatureNames'][()]]
+    assert names[-5:] == ['deta', 'dphi', 'logptrel', 'logerel', 'deltaR']
+    tree, owned = jet_constituents(path, jet_spec)
+    jets, constituents = jet_spec['jets']['branches'], jet_spec['constituents']['branches']
+    maxN = jet_spec['constituents']['maxN']
+    for row, (i, j) in enumerate(origin):
+        jet = {field: float(tree[jets[field]][i][j]) for field in ('pt', 'eta', 'phi', 'mass')}
+        jet_energy = math.hypot(jet['pt']*math.cosh(jet['eta']), jet['mass'])
+        expected = np.zeros((maxN, 5))
+        for n, c in enumerate(owned[i, j][:maxN]):
+            pt, eta, phi, m = (float(tree[constituents[field]][i][c]) for field in ('pt', 'eta', 'phi', 'm'))
+            deta, dphi = eta-jet['eta'], math.remainder(phi-jet['phi'], 2*math.pi)
+            energy = math.hypot(pt*math.cosh(eta), m)
+            expected[n] = deta, dphi, math.log(pt/jet['pt']), math.log(energy/jet_energy), math.hypot(deta, dphi)
+        np.testing.assert_allclose(cands[row,:,-5:], expected, rtol=1e-9, atol=1e-9)
+
+def test_event_features(ntuple, tmp_path):
+    '''event features computed event by event from the leading fat jets'''
+    path, spec_file = ntuple
+    features_spec = load_spec(spec_file)['event_features']
+    output = str(tmp_path/'events.h5')
+    convert_event_based(path, output, TREE, spec_file=spec_file, precision='double', features=True)
+    with h5py.File(output, 'r') as outFile:
+        features = outFile['EventFeatures'][()]
+        names = [n.decode() for n in outFile['EventFeatureNames'][()]]
+    fatjets = {field: '{}_{}'.format(features_spec['fatjets']['name'], field) for field in ('pt', 'eta', 'phi', 'mass')}
+    met = features_spec.get('met')
+    branches = [features_spec['jets']['name']+'_pt'] + list(fatjets.values())
+    branches += [met['name']+'_pt', met['name']+'_phi'] if met else []
+    tree = read_tree(path, branches)
+    assert names == ['HT', 'mjj', 'deta_jj'] + (['MET', 'MT', 'dphi_j1_met', 'dphi_j2_met', 'dphi_min_met'] if met else [])
+    for i, row in enumerate(features):
+        order = np.argsort(-tree[fatjets['pt']][i], kind='stable')
+        leading = [{field: float(tree[branch][i][o]) for field, branch in fatjets.items()} for o in order[:2]]
+        p4 = [(j['pt']*math.cos(j['phi']), j['pt']*math.sin(j['phi']), j['pt']*math.sinh(j['eta'])) for j in leading]
+        expected = {'HT': float(tree[features_spec['jets']['name']+'_pt'][i].astype('f8').sum()),
+                    'mjj': 0., 'deta_jj': 0., 'MT': 0., 'dphi_j1_met': 0., 'dphi_j2_met': 0., 'dphi_min_met': 0.}
+        px, py = sum(p[0] for p in p4), sum(p[1] for p in p4)
+        if len(leading) == 2:
+            energy = sum(math.sqrt(p[0]**2+p[1]**2+p[2]**2+j['mass']**2) for p, j in zip(p4, leading))
+            mjj = math.sqrt(max(energy**2-px**2-py**2-sum(p[2] for p in p4)**2, 0))
+            expected.update(mjj=mjj, deta_jj=abs(leading[0]['eta']-leading[1]['eta']))
+        if met:
+            met_pt, met_phi = float(tree[met['name']+'_pt'][i]), float(tree[met['name']+'_phi'][i])
+            expected['MET'] = met_pt
+            dphi = [abs(math.remainder(j['phi']-met_phi, 2*math.pi)) for j in leading]
+            if len(leading) == 2:
+                et_jj = math.sqrt(expected['mjj']**2+px**2+py**2)
+                mt2 = (et_jj+met_pt)**2 - (px+met_pt*math.cos(met_phi))**2 - (py+met_pt*math.sin(met_phi))**2
+                expected.update(MT=math.sqrt(max(mt2, 0)), dphi_j2_met=dphi[1])
+            if leading:
+                expected.update(dphi_j1_met=dphi[0], dphi_min_met=min(dphi))
+        np.testing.assert_allclose(row, [expected[name] for name in names], rtol=1e-7, atol=1e-6)
+
+def read_output(path):
+    '''every extendable dataset of an HDF5 output'''
+    with h5py.File(path, 'r') as outFile:
+        return {name: d[()] for name, d in extendable_datasets(outFile).items()}
+
+def test_incremental_resume(ntuple, tmp_path):
+    '''rows appended after the last input of the manifest, as by a job that died mid-file, are dropped and
+    converted again, and an input changed since its conversion is refused'''
+    path, spec_file = ntuple
+    first, second = str(tmp_path/'first.root'), str(tmp_path/'second.root')
+    shutil.copy(path, first)
+    make_ntuple(second, 120, spec_file=spec_file, seed=1, basket_size=50)
+    options = dict(spec_file=spec_file, layout='ragged')
+    clean = str(tmp_path/'clean.h5')
+    convert_incremental('event', [first, second], clean, TREE, **options)
+    output = str(tmp_path/'resumed.h5')
+    convert_incremental('event', [first], output, TREE, **options)
+    convert_event_based(second, output, TREE, append=True, entry_stop=70, **options)
+    crashed, expected = read_output(output), read_output(clean)
+    assert any(name.endswith('_offsets') for name in expected)
+    assert all(len(crashed[name]) < len(data) for name, data in expected.items())
+    convert_incremental('event', [first, second], output, TREE, **options)
+    resumed = read_output(output)
+    assert sorted(resumed) == sorted(expected)
+    for name, data in expected.items():
+        np.testing.assert_array_equal(resumed[name], data)
+    mtime = os.stat(first).st_mtime
+    os.utime(first, (mtime+10, mtime+10))
+    with pytest.raises(RuntimeError, match='changed after it was converted'):
+        convert_incremental('event', [first, second], output, TREE, **options)
+
+@pytest.mark.parametrize('layout', ['padded', 'ragged'])
+@pytest.mark.parametrize('outtype', ['event', 'jet'])
+@pytest.mark.parametrize('merge', [False, True])
+def test_stitch_shards(ntuple, tmp_path, outtype, merge, layout):
+    '''shards of a conversion, stitched with virtual datasets or merged, match the serial output including
+    the rebased offsets of the ragged layout and the statistics'''
+    path, spec_file = ntuple
+    options = dict(spec_file=spec_file, layout=layout, stats=True)
+    if outtype == 'jet':
+        options['all_jets'] = True
+    serial = str(tmp_path/'serial.h5')
+    CONVERTERS[outtype](path, serial, TREE, **options)
+    shards = make_shards([path], TREE, entries_per_shard=60)
+    assert len(shards) > 1
+    shard_files = [convert_shard(outtype, input_file, str(tmp_path/'shard_{}.h5'.format(ishard)), TREE,
+                                 entry_start, entry_stop, options)[0]
+                   for ishard, (input_file, entry_start, entry_stop) in enumerate(shards)]
+    output = str(tmp_path/'stitched.h5')
+    stitch_shards(shard_files, output, merge)
+    expected, stitched = read_output(serial), read_output(output)
+    assert sorted(stitched) == sorted(expected)
+    for name, data in expected.items():
+        np.testing.assert_array_equal(stitched[name], data)
+    with h5py.File(output, 'r') as outFile, h5py.File(serial, 'r') as serialFile:
+        assert any(d.is_virtual for d in extendable_datasets(outFile).values()) != merge
+        stats, expected_stats = read_stats(outFile), read_stats(serialFile)
+    assert sorted(stats) == sorted(expected_stats)
+    for name, s in expected_stats.items():
+        assert stats[name].count == s.count
+        np.testing.assert_allclose(stats[name].mean, s.mean, rtol=1e-9, atol=1e-9)
+        np.testing.assert_allclose(stats[name].m2, s.m2, rtol=1e-9, atol=1e-6)
+    assert all(os.path.exists(f) for f in shard_files) != merge
+
+def test_failed_conversion_releases_input(ntuple, tmp_path):
+    '''the input file and its thread pools are released when a conversion fails'''
+    path, spec_file = ntuple
+    threads = threading.active_count()
+    options = dict(spec_file=spec_file, decompression_threads=2, interpretation_threads=2)
+    with pytest.raises(KeyError):
+        convert_event_based(path, str(tmp_path/'missing.h5'), 'mmtree/missing', **options)
+    with pytest.raises(Exception):
+        convert_event_based(path, str(tmp_path/'cut.h5'), TREE, cut='missing_branch > 0', **options)
+    assert threading.active_count() == threads
+
+def test_multi_output_scans_once(ntuple, tmp_path, monkeypatch):
+    '''with maxn_quantile, the event and jet outputs of one pass share a single multiplicity pre-scan and
+    match the outputs converted separately'''
+    path, spec_file = ntuple
+    options = dict(spec_file=spec_file, maxn_quantile=0.9)
+    separate = [('event', str(tmp_path/'events.h5'), {}), ('jet', str(tmp_path/'jets.h5'), {'all_jets': True})]
+    for outtype, output, output_options in separate:
+        CONVERTERS[outtype](path, output, TREE, **dict(options, **output_options))
+    scans = []
+    scan_branches = convert_to_h5.scan_branches
+    monkeypatch.setattr(convert_to_h5, 'scan_branches', lambda tree, branches, *args: scans.append(branches)
+                        or scan_branches(tree, branches, *args))
+    together = [(outtype, str(tmp_path/('multi_'+os.path.basename(output))), output_options)
+                for outtype, output, output_options in separate]
+    convert_multi(path, together, TREE, **options)
+    assert len(scans) == 1
+    for (_, output, _), (_, multi_output, _) in zip(separate, together):
+        expected, converted = read_output(output), read_output(multi_output)
+        assert sorted(converted) == sorted(expected)
+        for name, data in expected.items():
+            np.testing.assert_array_equal(converted[name], data)
+        with h5py.File(output, 'r') as outFile, h5py.File(multi_output, 'r') as multiFile:
+            assert multiFile.attrs['maxN'] == outFile.attrs['maxN']
+            assert multiFile.attrs['truncation'] == outFile.attrs['truncation']
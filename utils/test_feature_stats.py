@@ -0,0 +1,23 @@
+from __future__ import print_function, division
+import numpy as np
+from feature_stats import FeatureStats, STATS_QUANTILES
+
+def test_feature_stats_merge():
+    '''statistics accumulated over uneven chunks, or merged from separate halves, match those of all values'''
+    rng = np.random.default_rng(3)
+    values = rng.normal(size=(20000, 3))*[1., 10., 0.1] + [0., 5., -1.]
+    values[:,2] = rng.exponential(size=len(values))
+    chunked = FeatureStats(3)
+    for chunk in np.split(values, [0, 7, 3000, 3001, 12000]):
+        chunked.update(chunk)
+    first, second = FeatureStats.from_values(values[:5000]), FeatureStats.from_values(values[5000:])
+    first.merge(second)
+    for stats in (chunked, first):
+        assert stats.count == len(values)
+        np.testing.assert_allclose(stats.mean, values.mean(axis=0), rtol=1e-10, atol=1e-12)
+        np.testing.assert_allclose(stats.std(), values.std(axis=0), rtol=1e-10)
+        np.testing.assert_array_equal(stats.min, values.min(axis=0))
+        np.testing.assert_array_equal(stats.max, values.max(axis=0))
+        # rank error of the t-digest quantiles, small in the tails
+        ranks = (values[:,None,:] <= stats.quantiles()[None]).mean(axis=0)
+        np.testing.assert_allclose(ranks, np.repeat(np.asarray(STATS_QUANTILES)[:,None], 3, axis=1), atol=2e-3)